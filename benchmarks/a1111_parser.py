@@ -0,0 +1,129 @@
+# Benchmark for the A1111 "parameters" parser in nodes.py
+#
+# Run from the ComfyUI folder (nodes.py imports ComfyUI's folder_paths):
+#   python custom_nodes/ImageWithMetadata/benchmarks/a1111_parser.py [image or text folder ...]
+#
+# Without arguments a built-in corpus of A1111 strings is used. With folders, the "parameters"
+# of every PNG (and the contents of every .txt file) found in them is parsed instead.
+
+import os
+import sys
+import re
+import time
+import importlib.util
+
+from PIL import Image
+
+sys.path.insert(0, os.getcwd())
+NODES_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "nodes.py")
+spec = importlib.util.spec_from_file_location("imagewithmetadata_nodes", NODES_FILE)
+nodes = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(nodes)
+
+
+CORPUS = [
+    # txt2img, multi-line prompt and negative, quoted values
+    "masterpiece, best quality, 1girl, solo, long hair, looking at viewer, smile,\n"
+    "outdoors, cherry blossoms, <lora:add_detail:0.6>\n"
+    "Negative prompt: lowres, bad anatomy, bad hands, text, error, missing fingers,\n"
+    "extra digit, fewer digits, cropped, worst quality, low quality\n"
+    "Steps: 28, Sampler: DPM++ 2M, Schedule type: Karras, CFG scale: 7, Seed: 1234567890, "
+    "Size: 832x1216, Model hash: 6ce0161689, Model: animagine-xl-3.1, VAE hash: 235745af8d, "
+    "VAE: sdxl_vae.safetensors, Lora hashes: \"add_detail: 7c6bad76eb54\", Version: v1.9.4",
+    # hires fix
+    "a photo of an astronaut riding a horse on mars, highly detailed\n"
+    "Negative prompt: blurry\n"
+    "Steps: 20, Sampler: Euler a, CFG scale: 7.5, Seed: 42, Size: 512x512, Model hash: cc6cb27103, "
+    "Model: v1-5-pruned-emaonly, Denoising strength: 0.45, Hires upscale: 2, Hires steps: 10, "
+    "Hires upscaler: R-ESRGAN 4x+, Version: v1.6.0",
+    # img2img without negative prompt
+    "landscape, mountains, lake, sunrise\n"
+    "Steps: 30, Sampler: DPM++ SDE, Schedule type: Karras, CFG scale: 5, Seed: 3735928559, "
+    "Size: 1024x1024, Model hash: 31e35c80fc, Model: sd_xl_base_1.0, Denoising strength: 0.6, "
+    "Mask blur: 4, Version: v1.10.1",
+    # ADetailer / extension parameters with quoted prompts
+    "1boy, armor, castle, dramatic lighting\n"
+    "Negative prompt: (worst quality:1.4), (low quality:1.4), monochrome\n"
+    "Steps: 25, Sampler: DPM++ 2M SDE, Schedule type: Exponential, CFG scale: 6, Seed: 987654321, "
+    "Size: 768x1152, Model hash: 67ab2fd8ec, Model: ponyDiffusionV6XL, Clip skip: 2, "
+    "ADetailer model: face_yolov8n.pt, ADetailer prompt: \"detailed face, \\\"sharp\\\" eyes\", "
+    "ADetailer confidence: 0.3, ADetailer version: 24.5.1, Version: f0.0.17v1.8.0rc",
+]
+
+
+def legacy_parse(params_text):
+    """The parser used before the single-pass tokenizer (split + four uncompiled searches)"""
+    metadata = {}
+    lines = params_text.split('\n')
+    if len(lines) >= 2:
+        metadata['positive_prompt'] = lines[0]
+        if 'Negative prompt:' in params_text:
+            parts = params_text.split('Negative prompt:')
+            metadata['positive_prompt'] = parts[0].strip()
+            remaining = parts[1]
+            if '\n' in remaining:
+                neg_parts = remaining.split('\n', 1)
+                metadata['negative_prompt'] = neg_parts[0].strip()
+                if len(neg_parts) > 1:
+                    param_line = neg_parts[1]
+                    seed_match = re.search(r'Seed:\s*(\d+)', param_line)
+                    if seed_match:
+                        metadata['seed'] = int(seed_match.group(1))
+                    steps_match = re.search(r'Steps:\s*(\d+)', param_line)
+                    if steps_match:
+                        metadata['steps'] = int(steps_match.group(1))
+                    cfg_match = re.search(r'CFG scale:\s*([\d.]+)', param_line)
+                    if cfg_match:
+                        metadata['cfg'] = float(cfg_match.group(1))
+                    sampler_match = re.search(r'Sampler:\s*([^,]+)', param_line)
+                    if sampler_match:
+                        metadata['sampler_name'] = sampler_match.group(1).strip()
+    return metadata
+
+
+def load_corpus(folders):
+    corpus = []
+    for folder in folders:
+        for root, _, files in os.walk(folder):
+            for name in files:
+                path = os.path.join(root, name)
+                try:
+                    if name.lower().endswith('.png'):
+                        with Image.open(path) as img:
+                            text = img.info.get('parameters')
+                    elif name.lower().endswith('.txt'):
+                        with open(path, 'r', encoding='utf-8') as f:
+                            text = f.read()
+                    else:
+                        continue
+                except:
+                    continue
+                if text and 'Steps:' in text:
+                    corpus.append(text)
+    return corpus
+
+
+def bench(parse, corpus, rounds):
+    start = time.perf_counter()
+    for _ in range(rounds):
+        for text in corpus:
+            parse(text)
+    elapsed = time.perf_counter() - start
+    return elapsed / (rounds * len(corpus)) * 1e6
+
+
+def main():
+    corpus = load_corpus(sys.argv[1:]) if len(sys.argv) > 1 else CORPUS
+    if not corpus:
+        print("No A1111 parameters found")
+        return
+
+    rounds = max(1, 200000 // len(corpus))
+    print(f"{len(corpus)} strings x {rounds} rounds")
+    for name, parse in (("legacy", legacy_parse), ("parse_a1111_parameters", nodes.parse_a1111_parameters)):
+        keys = sum(len(parse(text)) for text in corpus) / len(corpus)
+        print(f"{name:>24}: {bench(parse, corpus, rounds):7.2f} us/string, {keys:.1f} keys/string")
+
+
+if __name__ == "__main__":
+    main()
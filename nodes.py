@@ -7,58 +7,1374 @@ import json
 import numpy as np
 import torch
 from PIL import Image, ImageSequence, ImageOps
-from PIL.PngImagePlugin import PngInfo
+from PIL.PngImagePlugin import PngInfo, MAX_TEXT_CHUNK
 import folder_paths
 from datetime import datetime
 import re
 import glob
+import fnmatch
+import time
+import zlib
+import struct
+import queue
+import atexit
+import threading
+import sqlite3
+import socket
+import hashlib
+import pickle
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 
 
-# Counter persistence database (from WAS Node Suite pattern)
-class SimpleCounterDB:
+def get_data_directory():
+    """Folder for data that must survive restarts (ComfyUI cleans the temp directory at startup)"""
+    get_user_directory = getattr(folder_paths, "get_user_directory", None)
+    base_dir = get_user_directory() if get_user_directory else os.path.dirname(os.path.abspath(__file__))
+    return os.path.join(base_dir, "ImageWithMetadata")
+
+
+# Counter persistence database (WAS Node Suite pattern, stored in SQLite)
+class CounterDB:
+    """
+    Label counter/path/pattern store
+    SQLite in WAL mode: each update is a small upsert in one transaction (no full-file rewrite),
+    safe across threads (lock) and ComfyUI processes (SQLite file locking)
+    """
+    
     def __init__(self):
-        self.db_file = os.path.join(folder_paths.get_temp_directory(), "load_image_counters.json")
-        self.data = self.load()
+        self.db_file = os.path.join(folder_paths.get_temp_directory(), "load_image_counters.sqlite3")
+        self.legacy_file = os.path.join(folder_paths.get_temp_directory(), "load_image_counters.json")
+        self.lock = threading.Lock()
+        self.conn = None
     
-    def load(self):
-        if os.path.exists(self.db_file):
-            try:
-                with open(self.db_file, 'r', encoding='utf-8') as f:
-                    return json.load(f)
-            except:
-                return {}
-        return {}
+    def connect(self):
+        # Opened on first use (ComfyUI cleans the temp directory at startup)
+        if self.conn is None:
+            os.makedirs(os.path.dirname(self.db_file), exist_ok=True)
+            conn = sqlite3.connect(self.db_file, timeout=30, check_same_thread=False, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute("CREATE TABLE IF NOT EXISTS counters (key TEXT PRIMARY KEY, value TEXT)")
+            self.conn = conn
+            self.migrate()
+        return self.conn
     
-    def save(self):
+    def migrate(self):
+        """Import counters from the previous JSON file"""
+        if not os.path.exists(self.legacy_file):
+            return
         try:
-            with open(self.db_file, 'w', encoding='utf-8') as f:
-                json.dump(self.data, f)
+            with open(self.legacy_file, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+            self.conn.executemany("INSERT OR IGNORE INTO counters (key, value) VALUES (?, ?)",
+                                  [(key, json.dumps(value)) for key, value in data.items()])
+            os.replace(self.legacy_file, self.legacy_file + ".migrated")
         except:
             pass
     
+    def get(self, key, default=None):
+        with self.lock:
+            try:
+                row = self.connect().execute("SELECT value FROM counters WHERE key = ?", (key,)).fetchone()
+            except sqlite3.Error as e:
+                print(f"ImageWithMetadata: Counter database read failed: {e}")
+                return default
+        return json.loads(row[0]) if row else default
+    
+    def set_many(self, values):
+        """Write several keys in one transaction"""
+        with self.lock:
+            try:
+                conn = self.connect()
+                conn.execute("BEGIN IMMEDIATE")
+                try:
+                    conn.executemany(
+                        "INSERT INTO counters (key, value) VALUES (?, ?) "
+                        "ON CONFLICT(key) DO UPDATE SET value = excluded.value",
+                        [(key, json.dumps(value)) for key, value in values.items()])
+                    conn.execute("COMMIT")
+                except:
+                    conn.execute("ROLLBACK")
+                    raise
+            except sqlite3.Error as e:
+                print(f"ImageWithMetadata: Counter database write failed: {e}")
+    
+    def update(self, label, **fields):
+        """Set counter/path/pattern of a label in one write"""
+        self.set_many({f"{label}_{field}": value for field, value in fields.items()})
+    
     def get_counter(self, label):
-        return self.data.get(f"{label}_counter", 0)
+        return self.get(f"{label}_counter", 0)
     
     def set_counter(self, label, value):
-        self.data[f"{label}_counter"] = value
-        self.save()
+        self.update(label, counter=value)
     
     def get_path(self, label):
-        return self.data.get(f"{label}_path", "")
+        return self.get(f"{label}_path", "")
     
     def set_path(self, label, value):
-        self.data[f"{label}_path"] = value
-        self.save()
+        self.update(label, path=value)
     
     def get_pattern(self, label):
-        return self.data.get(f"{label}_pattern", "*")
+        return self.get(f"{label}_pattern", "*")
     
     def set_pattern(self, label, value):
-        self.data[f"{label}_pattern"] = value
-        self.save()
+        self.update(label, pattern=value)
+
+
+counter_db = CounterDB()
+
+
+# Encoder settings per profile ("balanced" matches the previous fixed settings)
+# PNG row filters aren't exposed by Pillow, compress_type selects the zlib strategy instead
+ENCODER_PROFILES = {
+    "balanced": {
+        "png": {"compress_level": 4},
+        "webp": {"quality": 95},
+        "jpg": {"quality": 95},
+    },
+    "fast": {
+        "png": {"compress_level": 1, "compress_type": zlib.Z_RLE},
+        "webp": {"quality": 90, "method": 0},
+        "jpg": {"quality": 92, "subsampling": "4:2:0"},
+    },
+    "archival": {
+        "png": {"compress_level": 9},
+        "webp": {"lossless": True, "quality": 100, "method": 6},
+        "jpg": {"quality": 98, "optimize": True, "progressive": True, "subsampling": "4:4:4"},
+    },
+}
+
+
+# Text chunks at least this large are stored compressed (zTXt / compressed iTXt) when enabled
+COMPRESSED_CHUNK_MIN_BYTES = 1024
+
+
+# EXIF tags used to embed user metadata in WebP/JPEG
+EXIF_IFD = 0x8769
+EXIF_USER_COMMENT = 0x9286
+EXIF_ORIENTATION = 0x0112
+# JPEG APP1 segment limit
+JPEG_MAX_EXIF_BYTES = 65533
+
+
+def read_exif_user_comment(exif_data):
+    """Return the EXIF UserComment text from raw EXIF bytes, or None"""
+    try:
+        exif = Image.Exif()
+        exif.load(exif_data)
+        raw = exif.get_ifd(EXIF_IFD).get(EXIF_USER_COMMENT)
+    except Exception:
+        return None
+    
+    if not raw:
+        return None
+    if isinstance(raw, str):
+        return raw
+    
+    # 8-byte character code prefix (A1111 writes UNICODE, we write ASCII)
+    prefix, payload = raw[:8], raw[8:]
+    if prefix == b"UNICODE\0":
+        encoding = "utf-16-be" if exif.endian == ">" else "utf-16-le"
+        return payload.decode(encoding, errors="ignore").rstrip("\0")
+    if prefix in (b"ASCII\0\0\0", b"\0" * 8):
+        return payload.decode("utf-8", errors="ignore").rstrip("\0")
+    return raw.decode("utf-8", errors="ignore").rstrip("\0")
+
+
+# A1111 "parameters" last line: "Key: value, Key: "quoted, value", ..." (same grammar as A1111's infotext parser)
+A1111_PARAM_RE = re.compile(r'\s*(\w[\w \-/]+):\s*("(?:\\.|[^\\"])+"|[^,]*)(?:,|$)')
+A1111_NEGATIVE_PREFIX = "Negative prompt:"
+# A1111 key -> (our metadata key, conversion or None)
+A1111_FIELDS = {
+    "Seed": ("seed", int),
+    "Steps": ("steps", int),
+    "CFG scale": ("cfg", float),
+    "Sampler": ("sampler_name", None),
+    "Schedule type": ("scheduler", None),
+    "Model": ("model", None),
+    "Model hash": ("model_hash", None),
+    "VAE": ("vae", None),
+}
+
+
+def parse_a1111_parameters(text):
+    """
+    Parse A1111 "parameters" text in one pass
+    Prompt lines, then "Negative prompt:" lines (may span several lines), then a "Key: value, ..." line
+    Known keys are mapped to our metadata keys, all other keys are kept verbatim
+    """
+    text = text.strip()
+    head, _, last = text.rpartition("\n")
+    # Only a last line with at least 3 parameters is the parameter line (as in A1111)
+    # Fast path: fewer than 3 colons can't hold 3 parameters, the regex only runs on candidate lines
+    params = A1111_PARAM_RE.findall(last) if last.count(":") >= 3 else ()
+    if len(params) >= 3:
+        text = head
+    else:
+        params = ()
+    
+    # Prompt and negative prompt are sliced from the text at the first "Negative prompt:" line
+    split = ("\n" + text).find("\n" + A1111_NEGATIVE_PREFIX)
+    if split < 0:
+        metadata = {"positive_prompt": text.strip()}
+    else:
+        metadata = {"positive_prompt": text[:split].strip(),
+                    "negative_prompt": text[split + len(A1111_NEGATIVE_PREFIX):].strip()}
+    
+    for key, value in params:
+        if value[:1] == '"':
+            try:
+                value = json.loads(value)
+            except ValueError:
+                pass
+        
+        field = A1111_FIELDS.get(key)
+        if field is None:
+            metadata[key] = value
+        elif field[1] is None:
+            metadata[field[0]] = value
+        else:
+            try:
+                metadata[field[0]] = field[1](value)
+            except ValueError:
+                metadata[key] = value
+    
+    return metadata
+
+
+# Per-folder metadata manifest (one JSON record per line) written by metadata_save="manifest"
+MANIFEST_FILENAME = "metadata_manifest.jsonl"
+_manifest_lock = threading.Lock()
+
+
+class ManifestReader:
+    """
+    Cached per-folder manifest records
+    Each manifest is read once, later lookups only read the appended tail
+    """
+    
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.entries = {}
+    
+    def lookup(self, image_path):
+        """Return the manifest metadata for an image, or None"""
+        folder, name = os.path.split(os.path.abspath(image_path))
+        manifest_path = os.path.join(folder, MANIFEST_FILENAME)
+        try:
+            size = os.stat(manifest_path).st_size
+        except OSError:
+            return None
+        
+        with self.lock:
+            entry = self.entries.get(folder)
+            if entry is None or size < entry["offset"]:
+                # New or rewritten manifest
+                entry = {"offset": 0, "records": {}}
+                self.entries[folder] = entry
+            
+            if size > entry["offset"]:
+                try:
+                    with open(manifest_path, 'rb') as f:
+                        f.seek(entry["offset"])
+                        data = f.read(size - entry["offset"])
+                except OSError:
+                    return None
+                
+                # Only consume complete lines (a writer may be mid-append)
+                end = data.rfind(b"\n") + 1
+                for line in data[:end].splitlines():
+                    try:
+                        record = json.loads(line)
+                        entry["records"][record["file"]] = record["metadata"]
+                    except:
+                        pass
+                entry["offset"] += end
+            
+            return entry["records"].get(name)
+
+
+manifest_reader = ManifestReader()
+
+
+def _inflate_text(data):
+    """Decompress a zTXt/iTXt payload with PIL's text chunk size limit"""
+    decompressor = zlib.decompressobj()
+    text = decompressor.decompress(data, MAX_TEXT_CHUNK)
+    if decompressor.unconsumed_tail:
+        raise ValueError("Decompressed text chunk too large")
+    return text
+
+
+def _read_png_header_info(f):
+    info = {}
+    while True:
+        header = f.read(8)
+        if len(header) < 8:
+            break
+        length, chunk_type = struct.unpack(">I4s", header)
+        # Text chunks written by PIL/ComfyUI/A1111 come before the image data
+        if chunk_type in (b"IDAT", b"IEND"):
+            break
+        if chunk_type not in (b"tEXt", b"zTXt", b"iTXt", b"eXIf"):
+            f.seek(length + 4, os.SEEK_CUR)
+            continue
+        
+        data = f.read(length)
+        f.seek(4, os.SEEK_CUR)  # CRC
+        try:
+            if chunk_type == b"eXIf":
+                info["exif"] = data
+            elif chunk_type == b"tEXt":
+                key, _, value = data.partition(b"\0")
+                info[key.decode("latin-1")] = value.decode("latin-1")
+            elif chunk_type == b"zTXt":
+                key, _, value = data.partition(b"\0")
+                info[key.decode("latin-1")] = _inflate_text(value[1:]).decode("latin-1")
+            else:  # iTXt: key, compression flag/method, language, translated key, text
+                key, _, rest = data.partition(b"\0")
+                compressed = rest[0]
+                _, _, rest = rest[2:].partition(b"\0")
+                _, _, value = rest.partition(b"\0")
+                if compressed:
+                    value = _inflate_text(value)
+                info[key.decode("latin-1")] = value.decode("utf-8")
+        except Exception:
+            pass
+    return info
+
+
+def _read_webp_header_info(f):
+    info = {}
+    while True:
+        header = f.read(8)
+        if len(header) < 8:
+            break
+        chunk_type, length = struct.unpack("<4sI", header)
+        padded = length + (length & 1)
+        
+        if chunk_type == b"VP8X":
+            flags = f.read(padded)[0]
+            # EXIF (0x08) / XMP (0x04) flags: nothing to find without them
+            if not flags & 0x0C:
+                break
+        elif chunk_type in (b"EXIF", b"XMP "):
+            data = f.read(length)
+            f.seek(padded - length, os.SEEK_CUR)
+            info["exif" if chunk_type == b"EXIF" else "xmp"] = data
+        elif chunk_type in (b"VP8 ", b"VP8L") and not info and f.tell() == 20:
+            # Simple (non-extended) WebP has no metadata chunks
+            break
+        else:
+            # Extended WebP stores EXIF/XMP after the bitstream, skip over it without reading
+            f.seek(padded, os.SEEK_CUR)
+    return info
+
+
+def _read_jpeg_header_info(f):
+    info = {}
+    while True:
+        marker = f.read(2)
+        if len(marker) < 2 or marker[0] != 0xFF:
+            break
+        # Start of scan / end of image: entropy-coded data follows
+        if marker[1] in (0xDA, 0xD9):
+            break
+        if marker[1] == 0x01 or 0xD0 <= marker[1] <= 0xD7:
+            continue
+        length = struct.unpack(">H", f.read(2))[0] - 2
+        if marker[1] == 0xE1:
+            data = f.read(length)
+            if data.startswith(b"Exif\0\0"):
+                info["exif"] = data
+            elif data.startswith(b"http://ns.adobe.com/xap/1.0/\0"):
+                info["xmp"] = data[29:]
+        elif marker[1] == 0xFE:
+            info["comment"] = f.read(length)
+        else:
+            f.seek(length, os.SEEK_CUR)
+    return info
+
+
+def read_header_info(image_path):
+    """
+    Read embedded metadata without decoding the image
+    Streams PNG text/eXIf chunks, WebP EXIF/XMP chunks and JPEG APP1 segments, skipping pixel data
+    Returns an image.info-like dict for LoadImageWithMetadata.parse_embedded_metadata
+    """
+    try:
+        with open(image_path, 'rb') as f:
+            signature = f.read(12)
+            if signature.startswith(b"\x89PNG\r\n\x1a\n"):
+                f.seek(8)
+                return _read_png_header_info(f)
+            if signature[:4] == b"RIFF" and signature[8:12] == b"WEBP":
+                return _read_webp_header_info(f)
+            if signature.startswith(b"\xff\xd8"):
+                f.seek(2)
+                return _read_jpeg_header_info(f)
+    except (OSError, struct.error, IndexError):
+        pass
+    return {}
+
+
+class EncoderTimings:
+    """
+    Running ms-per-megapixel and KB-per-megapixel estimates for each (format, profile)
+    Used by the "auto" encoder profile to pick the smallest output that fits a latency budget
+    (the size order differs per format: lossless WebP "archival" is the largest WebP output)
+    """
+    
+    # Rough starting points, replaced by measurements as images are saved
+    DEFAULT_MS_PER_MP = {
+        "png": {"fast": 15.0, "balanced": 60.0, "archival": 400.0},
+        "webp": {"fast": 20.0, "balanced": 80.0, "archival": 900.0},
+        "jpg": {"fast": 8.0, "balanced": 12.0, "archival": 30.0},
+    }
+    DEFAULT_KB_PER_MP = {
+        "png": {"fast": 1800.0, "balanced": 1500.0, "archival": 1400.0},
+        "webp": {"fast": 40.0, "balanced": 90.0, "archival": 800.0},
+        "jpg": {"fast": 105.0, "balanced": 150.0, "archival": 360.0},
+    }
+    
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.estimates = {fmt: dict(values) for fmt, values in self.DEFAULT_MS_PER_MP.items()}
+        self.sizes = {fmt: dict(values) for fmt, values in self.DEFAULT_KB_PER_MP.items()}
+    
+    def record(self, image_format, profile, ms_per_mp, kb_per_mp=None):
+        with self.lock:
+            previous = self.estimates[image_format][profile]
+            self.estimates[image_format][profile] = previous * 0.8 + ms_per_mp * 0.2
+            if kb_per_mp is not None:
+                previous = self.sizes[image_format][profile]
+                self.sizes[image_format][profile] = previous * 0.8 + kb_per_mp * 0.2
+    
+    def choose(self, image_format, budget_ms_per_mp):
+        """Smallest-output profile (by measured size) whose time estimate fits the budget"""
+        with self.lock:
+            sizes = self.sizes[image_format]
+            for profile in sorted(sizes, key=sizes.get):
+                if self.estimates[image_format][profile] <= budget_ms_per_mp:
+                    return profile
+            # Nothing fits: the fastest profile
+            return min(self.estimates[image_format], key=self.estimates[image_format].get)
+
+
+encoder_timings = EncoderTimings()
+
+
+def images_to_uint8(images):
+    """
+    Convert an IMAGE batch to a host uint8 array
+    Scale/clamp/cast run once on the tensor's device, followed by a single compact copy to the host
+    """
+    with torch.no_grad():
+        pixels = images.mul(255.0).clamp_(0, 255).to(torch.uint8)
+    return pixels.cpu().numpy()
+
+
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.webp', '.bmp', '.gif')
+# Decode threads for batch mode
+LOAD_WORKERS = min(8, os.cpu_count() or 4)
+
+
+class DirectoryIndex:
+    """
+    Cached file listings keyed by (path, pattern, extensions)
+    Built with os.scandir following the glob pattern, invalidated when a visited directory's mtime changes
+    Also records which files have a .txt sidecar and which folders have a metadata manifest
+    """
+    
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.entries = {}
+    
+    def get(self, directory, pattern, extensions):
+        """Return {"paths": sorted abs paths, "sidecars": set, "manifests": set of folders}"""
+        key = (os.path.abspath(directory), pattern, extensions)
+        with self.lock:
+            entry = self.entries.get(key)
+        
+        if entry is None or not self.is_fresh(entry):
+            entry = self.build(key[0], pattern, extensions)
+            with self.lock:
+                self.entries[key] = entry
+        return entry
+    
+    def is_fresh(self, entry):
+        for dir_path, mtime in entry["dir_mtimes"].items():
+            try:
+                if os.stat(dir_path).st_mtime_ns != mtime:
+                    return False
+            except OSError:
+                return False
+        return True
+    
+    def build(self, directory, pattern, extensions):
+        entry = {"paths": [], "sidecars": set(), "manifests": set(), "dir_mtimes": {}}
+        names_cache = {}
+        found = set()
+        
+        def list_dir(dir_path):
+            # Scan each directory once: {name: is_dir}
+            if dir_path not in names_cache:
+                names = {}
+                try:
+                    entry["dir_mtimes"][dir_path] = os.stat(dir_path).st_mtime_ns
+                    with os.scandir(dir_path) as it:
+                        for item in it:
+                            try:
+                                names[item.name] = item.is_dir()
+                            except OSError:
+                                names[item.name] = False
+                except OSError:
+                    pass
+                names_cache[dir_path] = names
+            return names_cache[dir_path]
+        
+        def visible(name, part):
+            # glob wildcards don't match hidden names
+            return not name.startswith('.') or part.startswith('.')
+        
+        def visit(dir_path, parts):
+            names = list_dir(dir_path)
+            part, rest = parts[0], parts[1:]
+            
+            if part == "**":
+                if rest:
+                    visit(dir_path, rest)
+                else:
+                    found.update(os.path.join(dir_path, n) for n, is_dir in names.items() if not is_dir and visible(n, ""))
+                for name, is_dir in names.items():
+                    if is_dir and visible(name, ""):
+                        visit(os.path.join(dir_path, name), parts)
+            elif not glob.has_magic(part):
+                # Literal component
+                target = os.path.join(dir_path, part)
+                if rest:
+                    if os.path.isdir(target):
+                        visit(target, rest)
+                elif part in names or os.path.isfile(target):
+                    found.add(target)
+            else:
+                for name, is_dir in names.items():
+                    if not visible(name, part) or not fnmatch.fnmatch(name, part):
+                        continue
+                    if rest:
+                        if is_dir:
+                            visit(os.path.join(dir_path, name), rest)
+                    elif not is_dir:
+                        found.add(os.path.join(dir_path, name))
+        
+        parts = [p for p in pattern.replace(os.sep, "/").split("/") if p] or ["*"]
+        visit(directory, parts)
+        
+        for file_path in found:
+            if file_path.lower().endswith(extensions):
+                entry["paths"].append(os.path.abspath(file_path))
+        entry["paths"].sort()
+        
+        # Sidecar/manifest lookups from the scanned names (no per-load stat)
+        for file_path in entry["paths"]:
+            dir_path, name = os.path.split(file_path)
+            names = names_cache.get(dir_path)
+            if names is None:
+                names = list_dir(dir_path)
+            if os.path.splitext(name)[0] + '.txt' in names:
+                entry["sidecars"].add(file_path)
+            if MANIFEST_FILENAME in names:
+                entry["manifests"].add(dir_path)
+        
+        return entry
+
+
+image_index = DirectoryIndex()
+
+
+def open_image(image_path, max_side=0):
+    """
+    Open and decode an image with a single open/header parse
+    Text chunks and EXIF stay in image.info for load_metadata, transpose only runs when orientation is set
+    max_side > 0 downscales during decode (JPEG draft) or right after it (reduce/thumbnail)
+    """
+    with Image.open(image_path) as img:
+        if max_side and max(img.size) > max_side and img.format == "JPEG":
+            # DCT scaling: libjpeg decodes at 1/2, 1/4 or 1/8 size (never below the requested size)
+            scale = max_side / max(img.size)
+            img.draft("RGB", (max(1, int(img.width * scale)), max(1, int(img.height * scale))))
+        
+        # load() also reads text chunks stored after the image data
+        img.load()
+        
+        if max_side and max(img.size) > max_side:
+            # Cheap integer box reduction first, then an exact LANCZOS fit
+            factor = max(img.size) // max_side
+            if factor >= 2:
+                img = img.reduce(factor)
+            img.thumbnail((max_side, max_side), Image.LANCZOS)
+        
+        if "exif" in img.info and img.getexif().get(EXIF_ORIENTATION, 1) != 1:
+            return ImageOps.exif_transpose(img)
+        return img
+
+
+def file_key(path):
+    """(path, mtime_ns, size) identity of a file, or None if it can't be stat'ed"""
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return (path, st.st_mtime_ns, st.st_size)
+
+
+class ImagePrefetcher:
+    """
+    Decodes upcoming images on a background thread while the current prompt runs
+    Finished images go straight into image_cache (keyed by file identity and decode options), so
+    prefetched tensors count against the cache_mb budget and nothing is held outside it
+    """
+    
+    MAX_PENDING = 32
+    
+    def __init__(self):
+        # Reentrant: done callbacks of cancelled or already finished futures run under the lock
+        self.lock = threading.RLock()
+        self.pending = {}  # cache key -> future of a decode that isn't in the cache yet
+        self.executor = None
+    
+    def schedule(self, items, decode):
+        """items: (path, cache key) pairs; decode(path) returns the (tensor, metadata) entry to cache"""
+        with self.lock:
+            if self.executor is None:
+                self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="ImageWithMetadataPrefetch")
+            for path, key in items:
+                if key is not None and key not in self.pending:
+                    future = self.executor.submit(self.run, path, key, decode)
+                    self.pending[key] = future
+                    future.add_done_callback(lambda future, key=key: self.forget(key, future))
+            
+            # Drop the oldest queued decodes (dicts keep insertion order)
+            while len(self.pending) > self.MAX_PENDING:
+                oldest = next(iter(self.pending))
+                self.pending.pop(oldest).cancel()
+    
+    def run(self, path, key, decode):
+        entry = decode(path)
+        # Dropped here when it doesn't fit the budget
+        image_cache.put(key, entry, entry[0].nbytes)
+    
+    def forget(self, key, future):
+        with self.lock:
+            if self.pending.get(key) is future:
+                del self.pending[key]
+    
+    def wait(self, key):
+        """Wait for an in-flight prefetch of key; True if there was one (its result is then cached, if it fit)"""
+        with self.lock:
+            future = self.pending.get(key)
+        if future is None:
+            return False
+        try:
+            future.result()
+        except Exception:
+            pass
+        return True
+
+
+image_prefetcher = ImagePrefetcher()
+
+
+class LRUCache:
+    """
+    Process-wide LRU cache bounded by a byte budget, with hit/miss counters
+    Used for decoded images and loaded models; cached values are shared, don't modify them in place
+    """
+    
+    def __init__(self, budget_bytes):
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.budget = budget_bytes
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+    
+    def set_budget(self, budget_bytes):
+        with self.lock:
+            self.budget = budget_bytes
+            self.evict()
+    
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+    
+    def contains(self, key):
+        with self.lock:
+            return key in self.entries
+    
+    def put(self, key, value, nbytes):
+        """Store value; returns True if this value is now cached (shared)"""
+        with self.lock:
+            if key in self.entries or nbytes > self.budget:
+                return False
+            self.entries[key] = (value, nbytes)
+            self.size += nbytes
+            self.evict()
+            return True
+    
+    def evict(self):
+        while self.entries and self.size > self.budget:
+            _, (_, nbytes) = self.entries.popitem(last=False)
+            self.size -= nbytes
+    
+    def stats(self):
+        with self.lock:
+            return {"hits": self.hits, "misses": self.misses, "entries": len(self.entries),
+                    "bytes": self.size, "budget": self.budget}
+
+
+# Decoded (tensor, metadata) keyed by (abs path, mtime, size) + decode options
+image_cache = LRUCache(512 * 1024 * 1024)
+# Loaded (model, clip, vae) / VAE keyed by file identity, sized by file size
+model_cache = LRUCache(0)
+
+
+class RecentFolders:
+    """
+    (path, pattern) pairs the loader used, most recent first
+    Kept as a small JSON file in the user directory: the counter database lives in the temp
+    directory, which ComfyUI cleans at startup
+    """
+    
+    MAX_FOLDERS = 32
+    
+    def __init__(self):
+        self.file = os.path.join(get_data_directory(), "recent_folders.json")
+        self.lock = threading.Lock()
+        self.folders = None
+    
+    def get(self):
+        with self.lock:
+            if self.folders is None:
+                try:
+                    with open(self.file, 'r', encoding='utf-8') as f:
+                        self.folders = [tuple(folder) for folder in json.load(f)]
+                except:
+                    self.folders = []
+            return list(self.folders)
+    
+    def add(self, path, pattern):
+        """Record a folder (no write when it is already the most recent one)"""
+        folders = self.get()
+        if folders and folders[0] == (path, pattern):
+            return
+        folders = [(path, pattern)] + [folder for folder in folders if folder != (path, pattern)]
+        folders = folders[:self.MAX_FOLDERS]
+        with self.lock:
+            self.folders = folders
+            try:
+                os.makedirs(os.path.dirname(self.file), exist_ok=True)
+                temp_file = f"{self.file}.{os.getpid()}.tmp"
+                with open(temp_file, 'w', encoding='utf-8') as f:
+                    json.dump(folders, f)
+                os.replace(temp_file, self.file)
+            except OSError as e:
+                print(f"ImageWithMetadata: Failed to save recent folders: {e}")
+
+
+recent_folders = RecentFolders()
+
+
+def prewarm_image_indexes():
+    """Build listings for folders used before the server restart"""
+    for path, pattern in recent_folders.get():
+        try:
+            if os.path.isdir(path):
+                image_index.get(path, pattern, IMAGE_EXTENSIONS)
+        except Exception as e:
+            print(f"ImageWithMetadata: Failed to index '{path}': {e}")
+
+
+def image_to_tensor(image, dtype=torch.float32):
+    """
+    Convert a PIL RGB image to a (H, W, 3) tensor in [0, 1]
+    The uint8 pixels are divided straight into the only allocated output (no float temporaries)
+    """
+    pixels = np.asarray(image)
+    out = torch.empty(pixels.shape, dtype=dtype)
+    np.divide(pixels, np.float32(255.0), out=out.numpy(), casting="unsafe")
+    return out
+
+
+_prompt_finished_callbacks = []
+_prompt_hook_lock = threading.Lock()
+_prompt_hook_installed = False
+
+
+def on_prompt_finished(callback):
+    """
+    Call callback(success) after every prompt this ComfyUI instance executes
+    Hooks the server's prompt queue; returns False when it isn't available (e.g. outside the server)
+    """
+    global _prompt_hook_installed
+    with _prompt_hook_lock:
+        if not _prompt_hook_installed:
+            try:
+                from server import PromptServer
+                prompt_queue = PromptServer.instance.prompt_queue
+                task_done = prompt_queue.task_done
+            except:
+                return False
+            
+            def hooked_task_done(*args, **kwargs):
+                result = task_done(*args, **kwargs)
+                # task_done(item_id, history_result, status, ...)
+                status = args[2] if len(args) > 2 else kwargs.get("status")
+                success = getattr(status, "status_str", "success") == "success"
+                for finished in list(_prompt_finished_callbacks):
+                    try:
+                        finished(success)
+                    except Exception as e:
+                        print(f"ImageWithMetadata: Prompt completion callback failed: {e}")
+                return result
+            
+            prompt_queue.task_done = hooked_task_done
+            _prompt_hook_installed = True
+        _prompt_finished_callbacks.append(callback)
+        return True
+
+
+class LeaseStore:
+    """
+    Shared claim table for distributed mode (SQLite file next to the images)
+    Each execution leases the next free image; the lease is completed when the prompt finishes
+    (released again if the prompt failed). Leases are renewed in the background only while their
+    prompt runs, so only images of crashed workers expire.
+    """
+    
+    # Paths checked per query while looking for a free image
+    CLAIM_CHUNK = 500
+    
+    def __init__(self, db_file):
+        self.db_file = db_file
+        self.owner = f"{socket.gethostname()}:{os.getpid()}"
+        self.lock = threading.Lock()
+        self.active = {}
+        self.timeouts = {}
+        self.cursors = {}  # label -> (image_paths, count of leading done paths)
+        self.heartbeat = None
+        os.makedirs(os.path.dirname(db_file), exist_ok=True)
+        self.conn = sqlite3.connect(db_file, timeout=60, check_same_thread=False, isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS leases (label TEXT, path TEXT, state TEXT, owner TEXT, expires REAL, "
+            "PRIMARY KEY (label, path))")
+        # Without the server hook the previous lease is completed at the next claim instead
+        self.hooked = on_prompt_finished(self.finish)
+    
+    def claim_next(self, label, image_paths, timeout):
+        """Lease the next unprocessed image (or None)"""
+        with self.lock:
+            now = time.time()
+            conn = self.conn
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                previous = self.active.pop(label, None)
+                if previous is not None:
+                    # Same prompt claiming again (or no server hook): the previous image is done
+                    conn.execute("UPDATE leases SET state = 'done' WHERE label = ? AND path = ? AND owner = ?",
+                                 (label, previous, self.owner))
+                
+                image_path = self.find_free(conn, label, image_paths, now)
+                if image_path is not None:
+                    conn.execute(
+                        "INSERT INTO leases (label, path, state, owner, expires) VALUES (?, ?, 'leased', ?, ?) "
+                        "ON CONFLICT(label, path) DO UPDATE SET state = 'leased', owner = excluded.owner, "
+                        "expires = excluded.expires",
+                        (label, image_path, self.owner, now + timeout))
+                    self.active[label] = image_path
+                    self.timeouts[label] = timeout
+                conn.execute("COMMIT")
+            except:
+                conn.execute("ROLLBACK")
+                raise
+        
+        if image_path is not None:
+            self.start_heartbeat()
+        return image_path
+    
+    def find_free(self, conn, label, image_paths, now):
+        """
+        First path that is neither done nor under an unexpired lease
+        Paths are checked in chunks from the end of the leading run of done paths found by the
+        previous claim (kept while the listing is unchanged), so a claim doesn't read every done path
+        """
+        cursor = self.cursors.get(label)
+        done_count = cursor[1] if cursor is not None and cursor[0] is image_paths else 0
+        leading = True
+        for offset in range(done_count, len(image_paths), self.CLAIM_CHUNK):
+            chunk = image_paths[offset:offset + self.CLAIM_CHUNK]
+            taken = dict(conn.execute(
+                f"SELECT path, state FROM leases WHERE label = ? AND path IN ({','.join('?' * len(chunk))}) "
+                "AND (state = 'done' OR expires >= ?)", (label, *chunk, now)).fetchall())
+            for image_path in chunk:
+                state = taken.get(image_path)
+                if state is None:
+                    self.cursors[label] = (image_paths, done_count)
+                    return image_path
+                if leading and state == 'done':
+                    done_count += 1
+                else:
+                    leading = False
+        self.cursors[label] = (image_paths, done_count)
+        return None
+    
+    def finish(self, success):
+        """Prompt finished: complete its leases, or release them for another worker if it failed"""
+        with self.lock:
+            if not self.active:
+                return
+            try:
+                for label, image_path in self.active.items():
+                    if success:
+                        self.conn.execute(
+                            "UPDATE leases SET state = 'done' WHERE label = ? AND path = ? AND owner = ?",
+                            (label, image_path, self.owner))
+                    else:
+                        self.conn.execute(
+                            "DELETE FROM leases WHERE label = ? AND path = ? AND owner = ? AND state = 'leased'",
+                            (label, image_path, self.owner))
+            except sqlite3.Error as e:
+                print(f"ImageWithMetadata: Lease completion failed: {e}")
+            self.active.clear()
+    
+    def start_heartbeat(self):
+        if self.heartbeat is None or not self.heartbeat.is_alive():
+            self.heartbeat = threading.Thread(target=self.renew, name="ImageWithMetadataLease", daemon=True)
+            self.heartbeat.start()
+    
+    def renew(self):
+        """Renew the active leases, stops once none is left (idle worker)"""
+        while True:
+            with self.lock:
+                if not self.active or not self.hooked:
+                    # Without the hook a lease only ends at the next claim: let it expire instead
+                    self.heartbeat = None
+                    return
+                interval = min(self.timeouts[label] for label in self.active) / 3
+                try:
+                    now = time.time()
+                    for label, image_path in self.active.items():
+                        self.conn.execute(
+                            "UPDATE leases SET expires = ? WHERE label = ? AND path = ? AND owner = ? AND state = 'leased'",
+                            (now + self.timeouts[label], label, image_path, self.owner))
+                except sqlite3.Error as e:
+                    print(f"ImageWithMetadata: Lease renewal failed: {e}")
+            time.sleep(max(1.0, interval))
+
+
+# Lease database location inside the image folder (hidden, so the directory index skips it)
+LEASE_DB_PATH = os.path.join(".imagewithmetadata", "leases.sqlite3")
+_lease_stores = {}
+_lease_stores_lock = threading.Lock()
+
+
+def get_lease_store(directory):
+    db_file = os.path.join(os.path.abspath(directory), LEASE_DB_PATH)
+    with _lease_stores_lock:
+        if db_file not in _lease_stores:
+            _lease_stores[db_file] = LeaseStore(db_file)
+        return _lease_stores[db_file]
+
+
+SEARCH_DB_PATH = os.path.join(".imagewithmetadata", "search.sqlite3")
+# Text fields of load_metadata() indexed for full-text search
+SEARCH_TEXT_FIELDS = ("positive_prompt", "negative_prompt", "model", "vae", "sampler_name", "scheduler", "memo")
+# Bumped when the table layout changes (older indexes are dropped and rebuilt)
+SEARCH_SCHEMA_VERSION = 3
+# An unchanged listing is still re-checked file by file after this many seconds (files rewritten in place)
+SEARCH_REFRESH_SECONDS = 10.0
+
+
+class MetadataSearchIndex:
+    """
+    SQLite FTS5 index of the metadata of one image folder, stored in the folder (.imagewithmetadata/search.sqlite3)
+    Updated incrementally: only new or modified files (path, mtime_ns, size) are read, deleted files are dropped
+    """
+    
+    def __init__(self, directory):
+        self.directory = os.path.abspath(directory)
+        self.db_file = os.path.join(self.directory, SEARCH_DB_PATH)
+        self.lock = threading.Lock()
+        self.conn = None
+        self.synced = {}  # pattern -> (directory index entry, time) of the last sync
+    
+    def connect(self):
+        with self.lock:
+            return self.open()
+    
+    def open(self):
+        if self.conn is None:
+            os.makedirs(os.path.dirname(self.db_file), exist_ok=True)
+            conn = sqlite3.connect(self.db_file, timeout=30, check_same_thread=False, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            if conn.execute("PRAGMA user_version").fetchone()[0] != SEARCH_SCHEMA_VERSION:
+                conn.execute("DROP TABLE IF EXISTS images")
+                conn.execute("DROP TABLE IF EXISTS images_fts")
+                conn.execute(f"PRAGMA user_version = {SEARCH_SCHEMA_VERSION}")
+            # Seeds are stored as decimal text: they go up to 0xffffffffffffffff, beyond SQLite's signed 64-bit INTEGER
+            conn.execute("CREATE TABLE IF NOT EXISTS images (id INTEGER PRIMARY KEY, path TEXT UNIQUE, "
+                         "mtime_ns INTEGER, size INTEGER, source TEXT, seed TEXT, steps INTEGER, cfg REAL, "
+                         "model_hash TEXT)")
+            conn.execute(f"CREATE VIRTUAL TABLE IF NOT EXISTS images_fts USING fts5({', '.join(SEARCH_TEXT_FIELDS)})")
+            self.conn = conn
+        return self.conn
+    
+    def sync(self, pattern, listing):
+        """
+        Bring the index up to date with a directory index listing
+        Skipped while the listing is unchanged, except for a file-by-file check every SEARCH_REFRESH_SECONDS
+        """
+        synced = self.synced.get(pattern)
+        if synced is not None and synced[0] is listing and time.time() - synced[1] < SEARCH_REFRESH_SECONDS:
+            return
+        
+        conn = self.open()
+        stored = {path: (row_id, mtime_ns, size, source) for row_id, path, mtime_ns, size, source
+                  in conn.execute("SELECT id, path, mtime_ns, size, source FROM images")}
+        
+        # Listing paths are absolute paths under self.directory
+        prefix_length = len(os.path.join(self.directory, ""))
+        changed = []
+        listed = set()
+        for image_path in listing["paths"]:
+            rel_path = image_path[prefix_length:]
+            listed.add(rel_path)
+            key = file_key(image_path)
+            if key is None:
+                # Vanished since the listing was built
+                continue
+            _, mtime_ns, size = key
+            source = self.source_key(image_path, listing)
+            known = stored.get(rel_path)
+            if known is None or known[1:] != (mtime_ns, size, source):
+                changed.append((image_path, mtime_ns, size, source))
+        
+        # Other patterns may share the database, only drop unlisted files that no longer exist
+        removed = [row_id for path, (row_id, _, _, _) in stored.items()
+                   if path not in listed and not os.path.exists(os.path.join(self.directory, path))]
+        
+        loader = LoadImageWithMetadata()
+        read = lambda item: loader.load_metadata(item[0], has_sidecar=item[0] in listing["sidecars"],
+                                                 has_manifest=os.path.dirname(item[0]) in listing["manifests"])
+        records = list(get_executor("thread", LOAD_WORKERS).map(read, changed)) if changed else []
+        
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            for row_id in removed:
+                conn.execute("DELETE FROM images WHERE id = ?", (row_id,))
+                conn.execute("DELETE FROM images_fts WHERE rowid = ?", (row_id,))
+            for (image_path, mtime_ns, size, source), metadata in zip(changed, records):
+                self.store(conn, image_path[prefix_length:], mtime_ns, size, source, metadata or {})
+            conn.execute("COMMIT")
+        except:
+            conn.execute("ROLLBACK")
+            raise
+        self.synced[pattern] = (listing, time.time())
+    
+    def source_key(self, image_path, listing):
+        """
+        Identity of the external metadata of an image: .txt sidecar (mtime, size) and folder manifest record
+        The manifest record itself is compared, appends for other images don't re-read every image
+        """
+        parts = []
+        if image_path in listing["sidecars"]:
+            key = file_key(os.path.splitext(image_path)[0] + '.txt')
+            if key is not None:
+                parts.append(f"{key[1]}:{key[2]}")
+        if os.path.dirname(image_path) in listing["manifests"]:
+            record = manifest_reader.lookup(image_path)
+            if record is not None:
+                parts.append("%08x" % zlib.crc32(json.dumps(record, sort_keys=True).encode("utf-8")))
+        return "|".join(parts)
+    
+    def store(self, conn, rel_path, mtime_ns, size, source, metadata):
+        def number(key, convert):
+            try:
+                return convert(metadata[key])
+            except:
+                return None
+        
+        row = conn.execute("SELECT id FROM images WHERE path = ?", (rel_path,)).fetchone()
+        if row:
+            conn.execute("DELETE FROM images_fts WHERE rowid = ?", (row[0],))
+            conn.execute("DELETE FROM images WHERE id = ?", (row[0],))
+        cursor = conn.execute(
+            "INSERT INTO images (path, mtime_ns, size, source, seed, steps, cfg, model_hash) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            (rel_path, mtime_ns, size, source, number("seed", lambda seed: str(int(seed))), number("steps", int),
+             number("cfg", float), str(metadata.get("model_hash") or "")))
+        conn.execute(f"INSERT INTO images_fts (rowid, {', '.join(SEARCH_TEXT_FIELDS)}) "
+                     f"VALUES (?{', ?' * len(SEARCH_TEXT_FIELDS)})",
+                     [cursor.lastrowid] + [str(metadata.get(field) or "") for field in SEARCH_TEXT_FIELDS])
+    
+    def search(self, pattern, listing, query="", seed=-1, limit=0):
+        """Positions of matching images in listing["paths"] (the loader's index)"""
+        with self.lock:
+            self.sync(pattern, listing)
+            
+            sql = "SELECT images.path FROM images"
+            conditions = []
+            params = []
+            if query.strip():
+                sql += " JOIN images_fts ON images_fts.rowid = images.id"
+                conditions.append("images_fts MATCH ?")
+                params.append(query)
+            if seed >= 0:
+                conditions.append("images.seed = ?")
+                params.append(str(seed))
+            if conditions:
+                sql += " WHERE " + " AND ".join(conditions)
+            
+            try:
+                rows = self.open().execute(sql, params).fetchall()
+            except sqlite3.OperationalError as e:
+                raise ValueError(f"Invalid search query '{query}': {e}")
+        
+        matches = {os.path.join(self.directory, row[0]) for row in rows}
+        positions = [i for i, image_path in enumerate(listing["paths"]) if image_path in matches]
+        return positions[:limit] if limit > 0 else positions
+
+
+_search_indexes = {}
+_search_indexes_lock = threading.Lock()
+
+
+def get_search_index(directory):
+    directory = os.path.abspath(directory)
+    with _search_indexes_lock:
+        if directory not in _search_indexes:
+            _search_indexes[directory] = MetadataSearchIndex(directory)
+        return _search_indexes[directory]
+
+
+def write_image_job(job):
+    """Encode and write one image and its optional text file"""
+    start = time.perf_counter()
+    job["image"].save(job["image_path"], **job["save_kwargs"])
+    
+    # Feed the auto profile (measurements from process workers stay in the worker)
+    megapixels = job["image"].width * job["image"].height / 1e6
+    if megapixels > 0:
+        elapsed_ms = (time.perf_counter() - start) * 1000.0
+        try:
+            kb_per_mp = os.path.getsize(job["image_path"]) / 1024.0 / megapixels
+        except OSError:
+            kb_per_mp = None
+        encoder_timings.record(job["image_format"], job["profile"], elapsed_ms / megapixels, kb_per_mp)
+    
+    if job["text_path"]:
+        with open(job["text_path"], 'w', encoding='utf-8') as f:
+            f.write(job["text"])
+    
+    # Appended after the image so a record always points to an existing file
+    if job["manifest_path"]:
+        with _manifest_lock:
+            with open(job["manifest_path"], 'a', encoding='utf-8') as f:
+                f.write(job["manifest_record"])
+
+
+_executors = {}
+_executors_lock = threading.Lock()
+
+
+def get_executor(worker_type, max_workers):
+    """Shared thread/process pool, kept alive between executions"""
+    key = (worker_type, max_workers)
+    with _executors_lock:
+        executor = _executors.get(key)
+        if executor is None:
+            if worker_type == "process":
+                executor = ProcessPoolExecutor(max_workers=max_workers)
+            else:
+                executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="ImageWithMetadata")
+            _executors[key] = executor
+    return executor
+
+
+# Set once the process pool failed (e.g. spawned workers can't import this module); threads are used from then on
+_process_pool_failed = False
+
 
+def is_process_pool_failure(error):
+    """
+    Failure of the process pool itself (dead workers, jobs that can't be pickled), not of the job
+    Both kinds arrive as the future's exception; pickling errors are TypeError/AttributeError mentioning pickle
+    """
+    if isinstance(error, (BrokenProcessPool, pickle.PicklingError)):
+        return True
+    return isinstance(error, (TypeError, AttributeError)) and "pickle" in str(error)
+
+
+def disable_process_pool(error):
+    global _process_pool_failed
+    if not _process_pool_failed:
+        _process_pool_failed = True
+        # Thread encoders release the GIL too
+        print(f"Warning: Process pool save failed ({error}), using threads from now on")
+
+
+def run_save_jobs(jobs, workers=1, worker_type="thread"):
+    """Encode and write a batch of save jobs, in parallel when workers > 1"""
+    if workers <= 1 or len(jobs) <= 1:
+        for job in jobs:
+            write_image_job(job)
+        return
+    
+    if worker_type == "process" and not _process_pool_failed:
+        remaining = []
+        write_error = None
+        try:
+            futures = [get_executor("process", workers).submit(write_image_job, job) for job in jobs]
+        except Exception as e:
+            if not is_process_pool_failure(e):
+                raise
+            disable_process_pool(e)
+            futures = []
+            remaining = jobs
+        
+        for job, future in zip(jobs, futures):
+            try:
+                future.result()
+            except Exception as e:
+                if is_process_pool_failure(e):
+                    # Only jobs that didn't complete are retried (no duplicate manifest lines)
+                    disable_process_pool(e)
+                    remaining.append(job)
+                elif write_error is None:
+                    # The job itself failed (encoder, file system): reported, not retried
+                    write_error = e
+        
+        if remaining:
+            list(get_executor("thread", workers).map(write_image_job, remaining))
+        if write_error is not None:
+            raise write_error
+        return
+    
+    list(get_executor("thread", workers).map(write_image_job, jobs))
+
+
+class BackgroundImageWriter:
+    """
+    Bounded background queue for SaveImageWithMetadata async mode
+    Encodes and writes images off the executor thread, blocks when the queue is full
+    """
+    
+    def __init__(self, max_pending=32):
+        self.queue = queue.Queue(maxsize=max_pending)
+        self.lock = threading.Lock()
+        self.threads = []
+        self.failures = []
+        self.next_counters = {}  # (folder, filename) -> [next free counter, files not yet written]
+        self.shutting_down = False
+        self.pid = os.getpid()
+    
+    def start(self, workers=1):
+        with self.lock:
+            self.threads = [t for t in self.threads if t.is_alive()]
+            while len(self.threads) < workers:
+                thread = threading.Thread(target=self.run, name="ImageWithMetadataWriter", daemon=True)
+                thread.start()
+                self.threads.append(thread)
+    
+    def submit(self, job, workers=1, worker_type="thread"):
+        """Queue a save job (backpressure: waits while the queue is full)"""
+        self.start(workers)
+        self.queue.put((job, worker_type, workers))
+    
+    def run(self):
+        while True:
+            job, worker_type, workers = self.queue.get()
+            try:
+                self.write(job, worker_type, workers)
+            except Exception as e:
+                print(f"ImageWithMetadata: Failed to write '{job['image_path']}': {e}")
+                with self.lock:
+                    self.failures.append((job["image_path"], str(e)))
+            finally:
+                self.release_counters(job["counter_key"])
+                self.queue.task_done()
+    
+    def write(self, job, worker_type, workers):
+        # Pools aren't usable during interpreter shutdown, the remaining queue is written here
+        if worker_type == "process" and workers > 1 and not _process_pool_failed and not self.shutting_down:
+            try:
+                get_executor("process", workers).submit(write_image_job, job).result()
+                return
+            except Exception as e:
+                if not is_process_pool_failure(e):
+                    raise
+                disable_process_pool(e)
+        write_image_job(job)
+    
+    def flush(self):
+        """Wait until every queued job is written"""
+        if any(t.is_alive() for t in self.threads):
+            self.queue.join()
+    
+    def shutdown(self):
+        """Write the remaining queue in the writer threads (interpreter exit)"""
+        # Forked pool workers inherit the hook but not the writer threads
+        if os.getpid() != self.pid:
+            return
+        self.shutting_down = True
+        self.flush()
+    
+    def pop_failures(self):
+        """Return and clear (path, error) pairs of failed background writes"""
+        with self.lock:
+            failures, self.failures = self.failures, []
+        return failures
+    
+    def claim_counters(self, folder, filename, counter, count):
+        """
+        Reserve a counter range for a batch, returns (first counter, reservation key)
+        Queued files don't exist on disk yet, so get_save_image_path can't see them
+        """
+        key = (os.path.normcase(os.path.abspath(folder)), filename)
+        with self.lock:
+            reserved = self.next_counters.setdefault(key, [0, 0])
+            counter = max(counter, reserved[0])
+            reserved[0] = counter + count
+            reserved[1] += count
+        return counter, key
+    
+    def release_counters(self, key, count=1):
+        """Files of a reservation were written (or failed), drop it once none are pending"""
+        with self.lock:
+            reserved = self.next_counters.get(key)
+            if reserved is not None:
+                reserved[1] -= count
+                if reserved[1] <= 0:
+                    del self.next_counters[key]
 
-counter_db = SimpleCounterDB()
+
+image_writer = BackgroundImageWriter()
+# Thread-exit hooks run before concurrent.futures shuts its pools down (plain atexit runs after)
+if hasattr(threading, "_register_atexit"):
+    threading._register_atexit(image_writer.shutdown)
+else:
+    atexit.register(image_writer.shutdown)
 
 
 class SaveImageWithMetadata:
@@ -68,7 +1384,6 @@ class SaveImageWithMetadata:
         self.output_dir = folder_paths.get_output_directory()
         self.type = "output"
         self.prefix_append = ""
-        self.compress_level = 4
 
     @classmethod
     def INPUT_TYPES(s):
@@ -79,7 +1394,7 @@ class SaveImageWithMetadata:
                 "negative_prompt": ("STRING", {"multiline": True}),
                 "filename_prefix": ("STRING", {"default": "%date:yyMM%/%date:yyMMdd-hhmmss%"}),
                 "image_format": (["png", "webp", "jpg"],),
-                "metadata_save": (["png_metadata_only", "text_file_only", "both"],),
+                "metadata_save": (["png_metadata_only", "text_file_only", "both", "manifest"],),
                 "text_format": (["json", "plain_text"],),
             },
             "optional": {
@@ -98,6 +1413,13 @@ class SaveImageWithMetadata:
                 "save_scheduler": ("BOOLEAN", {"default": True}),
                 "save_steps": ("BOOLEAN", {"default": True}),
                 "save_cfg": ("BOOLEAN", {"default": True}),
+                "async_save": ("BOOLEAN", {"default": False}),
+                "save_workers": ("INT", {"default": 1, "min": 1, "max": 64, "step": 1}),
+                "worker_type": (["thread", "process"],),
+                "encoder_profile": (["balanced", "fast", "archival", "auto"],),
+                "encode_budget_ms": ("FLOAT", {"default": 50.0, "min": 1.0, "max": 10000.0, "step": 1.0}),
+                "compress_metadata": ("BOOLEAN", {"default": False}),
+                "model_hash": ("STRING", {"default": ""}),
             },
             "hidden": {"prompt": "PROMPT", "extra_pnginfo": "EXTRA_PNGINFO"},
         }
@@ -111,8 +1433,13 @@ class SaveImageWithMetadata:
                     image_format, metadata_save, text_format,
                     model_name="", vae_name="", seed=0, sampler_name=None, scheduler=None, steps=20, cfg=7.0, memo="",
                     save_model=True, save_vae=True, save_seed=True, save_sampler=True, 
-                    save_scheduler=True, save_steps=True, save_cfg=True,
-                    prompt=None, extra_pnginfo=None):
+                    save_scheduler=True, save_steps=True, save_cfg=True, async_save=False,
+                    save_workers=1, worker_type="thread", encoder_profile="balanced",
+                    encode_budget_ms=50.0, compress_metadata=False, model_hash="", prompt=None, extra_pnginfo=None):
+        
+        # Report background writes that failed since the last call
+        for failed_path, error in image_writer.pop_failures():
+            print(f"Warning: Background save failed for '{failed_path}': {error}")
         
         # Process filename prefix (date format)
         filename_prefix = self.process_filename_prefix(filename_prefix)
@@ -122,57 +1449,84 @@ class SaveImageWithMetadata:
             folder_paths.get_save_image_path(filename_prefix, self.output_dir, 
                                             images[0].shape[1], images[0].shape[0])
         
+        # Skip counters still held by queued (not yet written) files
+        counter, counter_key = image_writer.claim_counters(full_output_folder, filename, counter, len(images))
+        
         results = list()
+        jobs = list()
+        
+        # Encoder settings ("auto" targets encode_budget_ms per megapixel)
+        if encoder_profile == "auto":
+            encoder_profile = encoder_timings.choose(image_format, encode_budget_ms)
+        encoder_settings = ENCODER_PROFILES[encoder_profile][image_format]
         
         # Prepare metadata
         metadata_dict = self.prepare_metadata(
             positive_prompt, negative_prompt, model_name, vae_name, seed, sampler_name, 
             scheduler, steps, cfg, memo, save_model, save_vae, save_seed, save_sampler, 
-            save_scheduler, save_steps, save_cfg
+            save_scheduler, save_steps, save_cfg, model_hash
         )
         
-        for image in images:
-            i = 255. * image.cpu().numpy()
-            img = Image.fromarray(np.clip(i, 0, 255).astype(np.uint8))
+        # Serialize metadata once for the whole batch
+        pnginfo = None
+        if image_format == "png":
+            pnginfo = self.build_pnginfo(metadata_dict, metadata_save, compress_metadata, prompt, extra_pnginfo)
+        
+        exif_data = None
+        if image_format in ["webp", "jpg"] and metadata_save in ["png_metadata_only", "both"]:
+            exif_data = self.build_exif(metadata_dict, image_format)
+        
+        # Metadata that doesn't fit the JPEG EXIF segment goes to the text file instead of being dropped
+        embed_failed = image_format in ["webp", "jpg"] and metadata_save == "png_metadata_only" and exif_data is None
+        
+        text_content = None
+        if metadata_save in ["text_file_only", "both"] or embed_failed:
+            if text_format == "json":
+                text_content = json.dumps(metadata_dict, ensure_ascii=False, indent=2)
+            else:  # plain_text
+                text_content = self.format_plain_text(metadata_dict)
+        
+        # One device-to-host transfer for the whole batch
+        pixels = images_to_uint8(images)
+        
+        for image_pixels in pixels:
+            # Built from a view into the batch buffer (no per-image float temporaries)
+            img = Image.fromarray(image_pixels)
             
             # Generate filename
             file = f"{filename}_{counter:05d}_.{image_format}"
             
-            # Prepare PNG metadata
-            metadata = None
-            if image_format == "png":
-                metadata = PngInfo()
-                if prompt is not None:
-                    metadata.add_text("prompt", json.dumps(prompt))
-                if extra_pnginfo is not None:
-                    for x in extra_pnginfo:
-                        metadata.add_text(x, json.dumps(extra_pnginfo[x]))
-                
-                # Add custom metadata
-                if metadata_save in ["png_metadata_only", "both"]:
-                    metadata.add_text("user_metadata", json.dumps(metadata_dict))
+            save_kwargs = dict(encoder_settings)
+            if pnginfo is not None:
+                save_kwargs["pnginfo"] = pnginfo
+            if exif_data is not None:
+                save_kwargs["exif"] = exif_data
             
-            # Save image
-            img_path = os.path.join(full_output_folder, file)
-            if image_format == "png":
-                img.save(img_path, pnginfo=metadata, compress_level=self.compress_level)
-            elif image_format == "webp":
-                img.save(img_path, quality=95)
-            elif image_format == "jpg":
-                img.save(img_path, quality=95)
+            job = {
+                "image": img,
+                "image_path": os.path.join(full_output_folder, file),
+                "image_format": image_format,
+                "profile": encoder_profile,
+                "save_kwargs": save_kwargs,
+                "text_path": None,
+                "text": None,
+                "manifest_path": None,
+                "manifest_record": None,
+                "counter_key": counter_key,
+            }
             
-            # Save text file
-            if metadata_save in ["text_file_only", "both"]:
+            # Text file
+            if text_content is not None:
                 text_file = f"{filename}_{counter:05d}_.txt"
-                text_path = os.path.join(full_output_folder, text_file)
-                
-                if text_format == "json":
-                    with open(text_path, 'w', encoding='utf-8') as f:
-                        json.dump(metadata_dict, f, ensure_ascii=False, indent=2)
-                else:  # plain_text
-                    with open(text_path, 'w', encoding='utf-8') as f:
-                        f.write(self.format_plain_text(metadata_dict))
+                job["text_path"] = os.path.join(full_output_folder, text_file)
+                job["text"] = text_content
             
+            # Manifest record
+            if metadata_save == "manifest":
+                job["manifest_path"] = os.path.join(full_output_folder, MANIFEST_FILENAME)
+                job["manifest_record"] = json.dumps({"file": file, "metadata": metadata_dict}, ensure_ascii=False) + "\n"
+            
+            jobs.append(job)
             results.append({
                 "filename": file,
                 "subfolder": subfolder,
@@ -180,8 +1534,51 @@ class SaveImageWithMetadata:
             })
             counter += 1
         
+        # Save images (filenames are fixed above, so workers may finish in any order)
+        if async_save:
+            # Returns before encoding finishes
+            for job in jobs:
+                image_writer.submit(job, save_workers, worker_type)
+        else:
+            try:
+                run_save_jobs(jobs, save_workers, worker_type)
+            finally:
+                image_writer.release_counters(counter_key, len(jobs))
+        
         return {"ui": {"images": results}}
 
+    def build_pnginfo(self, metadata_dict, metadata_save, compress_metadata, prompt, extra_pnginfo):
+        """Build the PNG text chunks (shared by every image of the batch)"""
+        chunks = []
+        if prompt is not None:
+            chunks.append(("prompt", json.dumps(prompt)))
+        if extra_pnginfo is not None:
+            for x in extra_pnginfo:
+                chunks.append((x, json.dumps(extra_pnginfo[x])))
+        
+        # Add custom metadata
+        if metadata_save in ["png_metadata_only", "both"]:
+            chunks.append(("user_metadata", json.dumps(metadata_dict)))
+        
+        metadata = PngInfo()
+        for key, value in chunks:
+            # Large chunks (workflow JSON) go to zTXt/compressed iTXt; PIL reads both back into img.info
+            compress = compress_metadata and len(value) >= COMPRESSED_CHUNK_MIN_BYTES
+            metadata.add_text(key, value, zip=compress)
+        return metadata
+
+    def build_exif(self, metadata_dict, image_format):
+        """Build EXIF bytes carrying the user metadata in UserComment (WebP/JPEG)"""
+        exif = Image.Exif()
+        # json.dumps escapes non-ASCII, so the ASCII character code is exact
+        exif.get_ifd(EXIF_IFD)[EXIF_USER_COMMENT] = b"ASCII\0\0\0" + json.dumps(metadata_dict).encode("ascii")
+        exif_data = exif.tobytes()
+        
+        if image_format == "jpg" and len(exif_data) > JPEG_MAX_EXIF_BYTES:
+            print(f"Warning: Metadata too large for JPEG EXIF ({len(exif_data)} bytes), saved to a text file instead")
+            return None
+        return exif_data
+
     def process_filename_prefix(self, prefix):
         """Process date format in filename prefix"""
         now = datetime.now()
@@ -199,7 +1596,7 @@ class SaveImageWithMetadata:
 
     def prepare_metadata(self, positive_prompt, negative_prompt, model_name, vae_name, seed, 
                         sampler_name, scheduler, steps, cfg, memo, save_model, save_vae, 
-                        save_seed, save_sampler, save_scheduler, save_steps, save_cfg):
+                        save_seed, save_sampler, save_scheduler, save_steps, save_cfg, model_hash=""):
         """Prepare metadata dictionary"""
         metadata = {
             "positive_prompt": positive_prompt,
@@ -209,6 +1606,9 @@ class SaveImageWithMetadata:
         if save_model and model_name:
             metadata["model"] = model_name
         
+        if save_model and model_hash:
+            metadata["model_hash"] = model_hash
+        
         if save_vae and vae_name:
             metadata["vae"] = vae_name
         
@@ -238,6 +1638,8 @@ class SaveImageWithMetadata:
         
         if "model" in metadata:
             lines.append(f"Model: {metadata['model']}")
+        if "model_hash" in metadata:
+            lines.append(f"Model hash: {metadata['model_hash']}")
         if "vae" in metadata:
             lines.append(f"VAE: {metadata['vae']}")
         if "seed" in metadata:
@@ -277,7 +1679,7 @@ class LoadImageWithMetadata:
     def INPUT_TYPES(cls):
         return {
             "required": {
-                "mode": (["single_image", "incremental_image"],),
+                "mode": (["single_image", "incremental_image", "batch", "distributed"],),
                 "path": ("STRING", {"default": "", "multiline": False}),
                 "pattern": ("STRING", {"default": "*", "multiline": False}),
                 "label": ("STRING", {"default": "Batch 001", "multiline": False}),
@@ -285,64 +1687,226 @@ class LoadImageWithMetadata:
             },
             "optional": {
                 "filename_text_extension": (["true", "false"],),
+                "batch_size": ("INT", {"default": 4, "min": 1, "max": 256, "step": 1}),
+                "batch_fit": (["resize", "pad"],),
+                "prefetch": ("INT", {"default": 0, "min": 0, "max": 16, "step": 1}),
+                "cache_mb": ("INT", {"default": 512, "min": 0, "max": 65536, "step": 64}),
+                "max_side": ("INT", {"default": 0, "min": 0, "max": 16384, "step": 8}),
+                "output_dtype": (["float32", "float16"],),
+                "pin_memory": ("BOOLEAN", {"default": False}),
+                "lease_timeout": ("INT", {"default": 600, "min": 10, "max": 86400, "step": 10}),
             }
         }
     
-    RETURN_TYPES = ("IMAGE", "STRING", "STRING", "STRING", "STRING", "INT", "INT", "FLOAT")
-    RETURN_NAMES = ("image", "positive_prompt", "negative_prompt", "info", "filename_text", "seed", "steps", "cfg")
+    RETURN_TYPES = ("IMAGE", "STRING", "STRING", "STRING", "STRING", "INT", "INT", "FLOAT",
+                    "STRING", "STRING", "STRING", "INT", "INT", "FLOAT")
+    RETURN_NAMES = ("image", "positive_prompt", "negative_prompt", "info", "filename_text", "seed", "steps", "cfg",
+                    "positive_prompt_list", "negative_prompt_list", "filename_list", "seed_list", "steps_list", "cfg_list")
+    OUTPUT_IS_LIST = (False,) * 8 + (True,) * 6
     FUNCTION = "load_batch_images"
     CATEGORY = "image"
     
-    def load_batch_images(self, mode, path, pattern, label, index, filename_text_extension="true"):
+    @classmethod
+    def IS_CHANGED(cls, mode, **kwargs):
+        # distributed mode claims a new image on every execution
+        if mode == "distributed":
+            return float("NaN")
+        return ""
+    
+    def load_batch_images(self, mode, path, pattern, label, index, filename_text_extension="true",
+                          batch_size=4, batch_fit="resize", prefetch=0, cache_mb=512, max_side=0,
+                          output_dtype="float32", pin_memory=False, lease_timeout=600):
         # Use default input directory if path is empty
         if not path or path.strip() == "":
             path = folder_paths.get_input_directory()
         
         if not os.path.exists(path):
             # Return empty data on error
-            return (torch.zeros((1, 64, 64, 3)), "", "", "", "", 0, 20, 7.0)
+            return self.empty_result()
         
         # Use BatchImageLoader
         fl = self.BatchImageLoader(path, label, pattern)
         
         if not fl.image_paths:
-            return (torch.zeros((1, 64, 64, 3)), "", "", "", "", 0, 20, 7.0)
+            return self.empty_result()
         
-        # Get image based on mode
-        if mode == "single_image":
-            # single_image mode: use index (with wrap-around)
-            index = index % len(fl.image_paths)  # Ensure index is within range
-            image, filename, image_path = fl.get_image_by_id(index)
-            if image is None:
-                return (torch.zeros((1, 64, 64, 3)), "", "", "", "", 0, 20, 7.0)
+        # Get image paths based on mode (upcoming: first index to prefetch)
+        if mode == "batch":
+            # batch mode: batch_size images from index (with wrap-around), decoded in parallel
+            image_paths = [fl.image_paths[(index + i) % len(fl.image_paths)] for i in range(batch_size)]
+            upcoming = index + batch_size
         elif mode == "incremental_image":
             # incremental_image mode: use counter (index is ignored)
-            image, filename, image_path = fl.get_next_image()
-            if image is None:
-                return (torch.zeros((1, 64, 64, 3)), "", "", "", "", 0, 20, 7.0)
+            image_paths = [fl.get_next_path()]
+            upcoming = fl.index
+        elif mode == "distributed":
+            # distributed mode: claim the next image no other worker has processed or leased
+            try:
+                image_path = get_lease_store(path).claim_next(label, fl.image_paths, lease_timeout)
+            except (OSError, sqlite3.Error) as e:
+                print(f"ImageWithMetadata: Lease database error: {e}")
+                return self.empty_result()
+            if image_path is None:
+                print(f"ImageWithMetadata: All images of '{label}' are processed")
+                return self.empty_result()
+            image_paths = [image_path]
+            upcoming = None
         else:
+            # single_image mode: use index (with wrap-around)
             index = index % len(fl.image_paths)  # Ensure index is within range
-            image, filename, image_path = fl.get_image_by_id(index)
-            if image is None:
-                return (torch.zeros((1, 64, 64, 3)), "", "", "", "", 0, 20, 7.0)
-        
-        # Convert to RGB
-        image = image.convert("RGB")
+            image_paths = [fl.image_paths[index]]
+            upcoming = index + 1
+        
+        image_cache.set_budget(cache_mb * 1024 * 1024)
+        dtype = torch.float16 if output_dtype == "float16" else torch.float32
+        entries, shared = self.decode_entries(fl, image_paths, max_side, dtype)
+        tensors = self.fit_batch([tensor for tensor, _ in entries], batch_fit)
+        metadatas = [metadata for _, metadata in entries]
+        
+        # Decode the next images in the background while this prompt runs (into the cache, so it needs a budget)
+        if prefetch > 0 and cache_mb > 0 and upcoming is not None:
+            options = (max_side, dtype)
+            next_paths = [fl.image_paths[(upcoming + i) % len(fl.image_paths)] for i in range(prefetch)]
+            next_items = [(p, self.cache_key(fl, p, options)) for p in next_paths]
+            next_items = [(p, key) for p, key in next_items if not image_cache.contains(key)]
+            image_prefetcher.schedule(next_items, lambda p: self.decode_entry(fl, p, max_side, dtype))
         
         # Process filename
+        filenames = [os.path.basename(p) for p in image_paths]
         if filename_text_extension == "false":
-            filename = os.path.splitext(filename)[0]
+            filenames = [os.path.splitext(f)[0] for f in filenames]
         
-        # PIL to tensor (WAS method)
-        image_tensor = torch.from_numpy(np.array(image).astype(np.float32) / 255.0).unsqueeze(0)
+        # Cached tensors are never handed downstream: a single image is copied only when the cache holds it
+        # Pinned output speeds up the host-to-GPU copy downstream (only the output is pinned, not the cache)
+        pin_memory = pin_memory and torch.cuda.is_available()
+        if len(tensors) == 1 and not shared[0] and not pin_memory:
+            image_tensor = tensors[0].unsqueeze(0)
+        else:
+            image_tensor = torch.empty((len(tensors),) + tuple(tensors[0].shape), dtype=dtype, pin_memory=pin_memory)
+            torch.stack(tensors, out=image_tensor)
         
-        # Load metadata
-        metadata = self.load_metadata(image_path)
+        return self.build_outputs(image_tensor, filenames, metadatas)
+    
+    def empty_result(self):
+        return self.build_outputs(torch.zeros((1, 64, 64, 3)), [""], [{}])
+    
+    def build_outputs(self, image_tensor, filenames, metadatas):
+        """Scalar outputs describe the first image, *_list outputs every image of the batch"""
+        metadata = metadatas[0]
+        return (
+            image_tensor,
+            metadata.get("positive_prompt", ""),
+            metadata.get("negative_prompt", ""),
+            self.format_info(metadata),
+            filenames[0],
+            metadata.get("seed", 0),
+            metadata.get("steps", 20),
+            metadata.get("cfg", 7.0),
+            [m.get("positive_prompt", "") for m in metadatas],
+            [m.get("negative_prompt", "") for m in metadatas],
+            filenames,
+            [m.get("seed", 0) for m in metadatas],
+            [m.get("steps", 20) for m in metadatas],
+            [m.get("cfg", 7.0) for m in metadatas],
+        )
+    
+    def decode_entries(self, fl, image_paths, max_side=0, dtype=torch.float32):
+        """
+        Decode images (cached/prefetched ones are reused, the rest decoded in parallel)
+        Returns (entries, shared): shared[i] is True when the image cache holds entries[i]
+        """
+        options = (max_side, dtype)
+        keys = [self.cache_key(fl, p, options) for p in image_paths]
+        entries = []
+        shared = []
+        for image_path, key in zip(image_paths, keys):
+            entry = None
+            if key is not None:
+                entry = image_cache.get(key)
+                # Prefetched images land in the cache
+                if entry is None and image_prefetcher.wait(key):
+                    entry = image_cache.get(key)
+            entries.append(entry)
+            shared.append(entry is not None)
+        missing = [i for i, entry in enumerate(entries) if entry is None]
+        
+        if len(missing) == 1:
+            entries[missing[0]] = self.decode_entry(fl, image_paths[missing[0]], max_side, dtype)
+        elif missing:
+            workers = min(len(missing), LOAD_WORKERS)
+            decoded = get_executor("thread", workers).map(
+                lambda i: self.decode_entry(fl, image_paths[i], max_side, dtype), missing)
+            for i, entry in zip(missing, decoded):
+                entries[i] = entry
+        
+        for i in missing:
+            if keys[i] is not None:
+                shared[i] = image_cache.put(keys[i], entries[i], entries[i][0].nbytes)
+        return entries, shared
+    
+    def cache_key(self, fl, image_path, options):
+        """Identity of the image and of the sidecar/manifest its cached metadata may come from"""
+        key = file_key(image_path)
+        if key is None:
+            return None
+        folder = os.path.dirname(image_path)
+        sidecar_key = file_key(os.path.splitext(image_path)[0] + '.txt') if image_path in fl.sidecars else None
+        manifest_key = file_key(os.path.join(folder, MANIFEST_FILENAME)) if folder in fl.manifests else None
+        return key + (sidecar_key, manifest_key) + options
+    
+    def decode_entry(self, fl, image_path, max_side=0, dtype=torch.float32):
+        """Decode one image to an RGB float tensor (H, W, 3) and load its metadata"""
+        image = open_image(image_path, max_side)
+        
+        # Text chunks / EXIF from the same open (convert() would copy them too)
+        image_info = image.info
+        
+        # Convert to RGB
+        image = image.convert("RGB")
+        
+        # PIL to tensor (single allocation, optionally float16)
+        image_tensor = image_to_tensor(image, dtype)
         
-        # Generate info string
+        # Load metadata (sidecar/manifest presence is known from the directory index)
+        metadata = self.load_metadata(image_path, info=image_info,
+                                      has_sidecar=image_path in fl.sidecars,
+                                      has_manifest=os.path.dirname(image_path) in fl.manifests)
+        return image_tensor, metadata
+    
+    def fit_batch(self, tensors, batch_fit):
+        """Bring batch images to a common size (resize to the first image, or pad to the largest)"""
+        if all(t.shape == tensors[0].shape for t in tensors):
+            return tensors
+        
+        if batch_fit == "pad":
+            height = max(t.shape[0] for t in tensors)
+            width = max(t.shape[1] for t in tensors)
+            fitted = []
+            for t in tensors:
+                canvas = torch.zeros((height, width, 3), dtype=t.dtype)
+                top, left = (height - t.shape[0]) // 2, (width - t.shape[1]) // 2
+                canvas[top:top + t.shape[0], left:left + t.shape[1]] = t
+                fitted.append(canvas)
+            return fitted
+        
+        size = tuple(tensors[0].shape[:2])
+        fitted = []
+        for t in tensors:
+            if tuple(t.shape[:2]) != size:
+                # Interpolate in float32 (half precision isn't supported on every device)
+                resized = torch.nn.functional.interpolate(t.float().movedim(-1, 0).unsqueeze(0), size=size,
+                                                          mode="bicubic", antialias=True)
+                t = resized.squeeze(0).movedim(0, -1).clamp(0, 1).to(t.dtype)
+            fitted.append(t)
+        return fitted
+    
+    def format_info(self, metadata):
+        """Generate info string"""
         info_lines = []
         if "model" in metadata and metadata["model"]:
             info_lines.append(f"MODEL: {metadata['model']}")
+        if "model_hash" in metadata and metadata["model_hash"]:
+            info_lines.append(f"Model hash: {metadata['model_hash']}")
         if "vae" in metadata and metadata["vae"]:
             info_lines.append(f"VAE: {metadata['vae']}")
         if "sampler_name" in metadata and metadata["sampler_name"]:
@@ -350,18 +1914,7 @@ class LoadImageWithMetadata:
         if "scheduler" in metadata and metadata["scheduler"]:
             info_lines.append(f"Scheduler: {metadata['scheduler']}")
         
-        info_text = "\n".join(info_lines) if info_lines else ""
-        
-        return (
-            image_tensor,
-            metadata.get("positive_prompt", ""),
-            metadata.get("negative_prompt", ""),
-            info_text,
-            filename,
-            metadata.get("seed", 0),
-            metadata.get("steps", 20),
-            metadata.get("cfg", 7.0)
-        )
+        return "\n".join(info_lines) if info_lines else ""
     
     class BatchImageLoader:
         """
@@ -372,8 +1925,10 @@ class LoadImageWithMetadata:
         def __init__(self, directory_path, label, pattern):
             self.DB = counter_db
             self.image_paths = []
+            self.sidecars = set()
+            self.manifests = set()
             self.load_images(directory_path, pattern)
-            self.image_paths.sort()
+            recent_folders.add(directory_path, pattern)
             
             # Counter management (WAS method)
             stored_directory_path = self.DB.get_path(label)
@@ -381,22 +1936,18 @@ class LoadImageWithMetadata:
             
             if stored_directory_path != directory_path or stored_pattern != pattern:
                 self.index = 0
-                self.DB.set_counter(label, 0)
-                self.DB.set_path(label, directory_path)
-                self.DB.set_pattern(label, pattern)
+                self.DB.update(label, counter=0, path=directory_path, pattern=pattern)
             else:
                 self.index = self.DB.get_counter(label)
             
             self.label = label
         
         def load_images(self, directory_path, pattern):
-            """Load image file list (WAS method)"""
-            allowed_extensions = ('.png', '.jpg', '.jpeg', '.webp', '.bmp', '.gif')
-            
-            for file_name in glob.glob(os.path.join(glob.escape(directory_path), pattern), recursive=True):
-                if file_name.lower().endswith(allowed_extensions):
-                    abs_file_path = os.path.abspath(file_name)
-                    self.image_paths.append(abs_file_path)
+            """Load image file list from the cached directory index (sorted, shared: don't mutate)"""
+            listing = image_index.get(directory_path, pattern, IMAGE_EXTENSIONS)
+            self.image_paths = listing["paths"]
+            self.sidecars = listing["sidecars"]
+            self.manifests = listing["manifests"]
         
         def get_image_by_id(self, image_id):
             """Get image by ID (WAS method)"""
@@ -405,12 +1956,17 @@ class LoadImageWithMetadata:
                 return (None, None, None)
             
             image_path = self.image_paths[image_id]
-            i = Image.open(image_path)
-            i = ImageOps.exif_transpose(i)
+            i = open_image(image_path)
             return (i, os.path.basename(image_path), image_path)
         
         def get_next_image(self):
             """Get next image and increment counter (WAS method)"""
+            image_path = self.get_next_path()
+            i = open_image(image_path)
+            return (i, os.path.basename(image_path), image_path)
+        
+        def get_next_path(self):
+            """Get next image path and increment counter (without decoding)"""
             if self.index >= len(self.image_paths):
                 self.index = 0
             
@@ -423,39 +1979,37 @@ class LoadImageWithMetadata:
             # Save counter
             self.DB.set_counter(self.label, self.index)
             
-            i = Image.open(image_path)
-            i = ImageOps.exif_transpose(i)
-            return (i, os.path.basename(image_path), image_path)
+            return image_path
     
-    def load_metadata(self, image_path):
-        """Load metadata from image or text file"""
+    def load_metadata(self, image_path, info=None, has_sidecar=None, has_manifest=None):
+        """
+        Load metadata from image, folder manifest or text file
+        info: image.info of an already opened image (avoids opening the file again)
+        has_sidecar/has_manifest skip the existence checks when already known (None = check)
+        """
         metadata = {}
         
-        # Try PNG metadata first
-        if image_path.lower().endswith('.png'):
+        # Try embedded metadata first (PNG text chunks, WebP/JPEG EXIF UserComment)
+        if image_path.lower().endswith(('.png', '.webp', '.jpg', '.jpeg')):
             try:
-                img = Image.open(image_path)
-                if 'user_metadata' in img.info:
-                    # Our custom format
-                    try:
-                        metadata = json.loads(img.info['user_metadata'])
-                        return metadata
-                    except:
-                        pass
-                elif 'parameters' in img.info:
-                    # A1111 format
-                    try:
-                        params = img.info['parameters']
-                        metadata = self.parse_a1111_metadata(params)
-                        return metadata
-                    except:
-                        pass
+                if info is None:
+                    # Header-only read, pixel data is never touched
+                    info = read_header_info(image_path)
+                metadata = self.parse_embedded_metadata(info)
+                if metadata:
+                    return metadata
             except:
                 pass
         
+        # Try folder manifest
+        if has_manifest is not False:
+            record = manifest_reader.lookup(image_path)
+            if record:
+                return record
+        
         # Try text file
         text_path = os.path.splitext(image_path)[0] + '.txt'
-        if os.path.exists(text_path):
+        if has_sidecar or (has_sidecar is None and os.path.exists(text_path)):
             try:
                 with open(text_path, 'r', encoding='utf-8') as f:
                     content = f.read()
@@ -476,56 +2030,33 @@ class LoadImageWithMetadata:
         
         return metadata
     
-    def parse_a1111_metadata(self, params_text):
-        """Parse A1111 format metadata"""
-        metadata = {}
-        
-        # Basic parsing (can be enhanced)
-        lines = params_text.split('\n')
-        if len(lines) >= 2:
-            metadata['positive_prompt'] = lines[0]
-            
-            # Parse parameters line
-            if 'Negative prompt:' in params_text:
-                parts = params_text.split('Negative prompt:')
-                metadata['positive_prompt'] = parts[0].strip()
-                remaining = parts[1]
-                
-                if '\n' in remaining:
-                    neg_parts = remaining.split('\n', 1)
-                    metadata['negative_prompt'] = neg_parts[0].strip()
-                    
-                    # Parse other parameters
-                    if len(neg_parts) > 1:
-                        param_line = neg_parts[1]
-                        metadata.update(self.parse_parameter_line(param_line))
-        
-        return metadata
-    
-    def parse_parameter_line(self, param_line):
-        """Parse parameter line (Steps: 20, Sampler: ..., etc.)"""
-        params = {}
-        
-        # Simple regex parsing
-        import re
-        
-        seed_match = re.search(r'Seed:\s*(\d+)', param_line)
-        if seed_match:
-            params['seed'] = int(seed_match.group(1))
-        
-        steps_match = re.search(r'Steps:\s*(\d+)', param_line)
-        if steps_match:
-            params['steps'] = int(steps_match.group(1))
-        
-        cfg_match = re.search(r'CFG scale:\s*([\d.]+)', param_line)
-        if cfg_match:
-            params['cfg'] = float(cfg_match.group(1))
+    def parse_embedded_metadata(self, info):
+        """Parse metadata from image info (PNG text chunks or raw EXIF)"""
+        if 'user_metadata' in info:
+            # Our custom format
+            try:
+                return json.loads(info['user_metadata'])
+            except:
+                pass
+        elif 'parameters' in info:
+            # A1111 format
+            try:
+                return parse_a1111_parameters(info['parameters'])
+            except:
+                pass
         
-        sampler_match = re.search(r'Sampler:\s*([^,]+)', param_line)
-        if sampler_match:
-            params['sampler_name'] = sampler_match.group(1).strip()
+        if 'exif' in info:
+            # WebP/JPEG: our JSON or A1111 parameters in UserComment
+            comment = read_exif_user_comment(info['exif'])
+            if comment:
+                try:
+                    if comment.lstrip().startswith('{'):
+                        return json.loads(comment)
+                    return parse_a1111_parameters(comment)
+                except:
+                    pass
         
-        return params
+        return {}
     
     def parse_plain_text_metadata(self, content):
         """Parse plain text format metadata"""
@@ -538,6 +2069,8 @@ class LoadImageWithMetadata:
         for line in lines:
             if line.startswith('Model:'):
                 metadata['model'] = line.replace('Model:', '').strip()
+            elif line.startswith('Model hash:'):
+                metadata['model_hash'] = line.replace('Model hash:', '').strip()
             elif line.startswith('VAE:'):
                 metadata['vae'] = line.replace('VAE:', '').strip()
             elif line.startswith('Seed:'):
@@ -584,6 +2117,425 @@ class LoadImageWithMetadata:
         return metadata
 
 
+class SearchImagesWithMetadata:
+    """
+    Search image metadata of a folder (SQLite FTS5 index, updated incrementally)
+    Outputs matching paths and their index for LoadImageWithMetadata (same path/pattern)
+    """
+    
+    @classmethod
+    def INPUT_TYPES(cls):
+        return {
+            "required": {
+                "path": ("STRING", {"default": "", "multiline": False}),
+                "pattern": ("STRING", {"default": "*", "multiline": False}),
+                "query": ("STRING", {"default": "", "multiline": False}),
+            },
+            "optional": {
+                "seed": ("INT", {"default": -1, "min": -1, "max": 0xffffffffffffffff, "step": 1}),
+                "limit": ("INT", {"default": 0, "min": 0, "max": 1000000, "step": 1}),
+            }
+        }
+    
+    RETURN_TYPES = ("STRING", "INT", "INT")
+    RETURN_NAMES = ("paths", "indices", "count")
+    OUTPUT_IS_LIST = (True, True, False)
+    FUNCTION = "search"
+    CATEGORY = "image"
+    
+    @classmethod
+    def IS_CHANGED(cls, **kwargs):
+        # Folder contents may have changed, the index update is incremental
+        return float("NaN")
+    
+    def search(self, path, pattern, query, seed=-1, limit=0):
+        # Use default input directory if path is empty
+        if not path or path.strip() == "":
+            path = folder_paths.get_input_directory()
+        
+        if not os.path.isdir(path):
+            print(f"Warning: Path '{path}' not found")
+            return ([], [], 0)
+        
+        try:
+            # Open the database first: creating it changes the folder mtime (would invalidate the listing)
+            search_index = get_search_index(path)
+            search_index.connect()
+            listing = image_index.get(path, pattern, IMAGE_EXTENSIONS)
+            indices = search_index.search(pattern, listing, query, seed, limit)
+        except (OSError, sqlite3.DatabaseError) as e:
+            print(f"ImageWithMetadata: Search index error: {e}")
+            return ([], [], 0)
+        
+        return ([listing["paths"][i] for i in indices], indices, len(indices))
+
+
+def model_file_key(folder_name, name):
+    """File identity of a model in a ComfyUI model folder, or None"""
+    full_path = folder_paths.get_full_path(folder_name, name)
+    return file_key(os.path.abspath(full_path)) if full_path else None
+
+
+def load_checkpoint_cached(ckpt_name, cache_mb=0):
+    """
+    CheckpointLoaderSimple through the model cache (cache_mb=0: load from disk every time)
+    Only a positive cache_mb sets the shared budget, so loaders left at 0 don't evict other loaders' models
+    """
+    from nodes import CheckpointLoaderSimple
+    if cache_mb > 0:
+        model_cache.set_budget(cache_mb * 1024 * 1024)
+    key = model_file_key("checkpoints", ckpt_name) if cache_mb > 0 else None
+    
+    if key is not None:
+        cached = model_cache.get(("checkpoints",) + key)
+        if cached is not None:
+            return cached
+    
+    loaded = tuple(CheckpointLoaderSimple().load_checkpoint(ckpt_name)[:3])
+    if key is not None:
+        model_cache.put(("checkpoints",) + key, loaded, key[2])
+    return loaded
+
+
+def load_vae_cached(vae_name, cache_mb=0):
+    """VAELoader through the model cache"""
+    from nodes import VAELoader
+    if cache_mb > 0:
+        model_cache.set_budget(cache_mb * 1024 * 1024)
+    key = model_file_key("vae", vae_name) if cache_mb > 0 else None
+    
+    if key is not None:
+        cached = model_cache.get(("vae",) + key)
+        if cached is not None:
+            return cached
+    
+    vae = VAELoader().load_vae(vae_name)[0]
+    if key is not None:
+        model_cache.put(("vae",) + key, vae, key[2])
+    return vae
+
+
+class ModelHashService:
+    """
+    SHA-256 of model files, hashed in chunks on a background thread
+    Results are persisted in SQLite keyed by (path, size, mtime_ns), so each file is hashed once
+    """
+    
+    CHUNK_SIZE = 16 * 1024 * 1024
+    
+    def __init__(self):
+        self.db_file = os.path.join(get_data_directory(), "model_hashes.sqlite3")
+        self.lock = threading.Lock()
+        self.conn = None
+        self.hashes = {}
+        self.pending = {}
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="ImageWithMetadataHash")
+    
+    def connect(self):
+        if self.conn is None:
+            os.makedirs(os.path.dirname(self.db_file), exist_ok=True)
+            conn = sqlite3.connect(self.db_file, timeout=30, check_same_thread=False, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("CREATE TABLE IF NOT EXISTS hashes (path TEXT, size INTEGER, mtime_ns INTEGER, "
+                         "sha256 TEXT, PRIMARY KEY (path, size, mtime_ns))")
+            self.conn = conn
+        return self.conn
+    
+    def request(self, path):
+        """Start hashing path in the background unless its hash is known; returns the file key (None if missing)"""
+        key = file_key(os.path.abspath(path))
+        if key is None:
+            return None
+        with self.lock:
+            if key in self.hashes or key in self.pending:
+                return key
+            try:
+                row = self.connect().execute("SELECT sha256 FROM hashes WHERE path = ? AND size = ? AND mtime_ns = ?",
+                                             (key[0], key[2], key[1])).fetchone()
+            except sqlite3.Error as e:
+                print(f"ImageWithMetadata: Model hash database read failed: {e}")
+                row = None
+            if row:
+                self.hashes[key] = row[0]
+            else:
+                self.pending[key] = self.executor.submit(self.compute, key)
+        return key
+    
+    def get(self, path):
+        """Full sha256 hex digest of path (waits if it is still being hashed), "" on error"""
+        key = self.request(path)
+        if key is None:
+            print(f"Warning: Could not hash {path}: file not found")
+            return ""
+        with self.lock:
+            sha256 = self.hashes.get(key)
+            future = self.pending.get(key)
+        if sha256 is not None:
+            return sha256
+        try:
+            return future.result()
+        except Exception as e:
+            print(f"Warning: Could not hash {path}: {e}")
+            return ""
+    
+    def compute(self, key):
+        path = key[0]
+        try:
+            digest = hashlib.sha256()
+            buffer = bytearray(self.CHUNK_SIZE)
+            view = memoryview(buffer)
+            with open(path, 'rb', buffering=0) as f:
+                while True:
+                    read = f.readinto(buffer)
+                    if not read:
+                        break
+                    digest.update(view[:read])
+            sha256 = digest.hexdigest()
+            
+            with self.lock:
+                self.hashes[key] = sha256
+                try:
+                    self.connect().execute("INSERT OR REPLACE INTO hashes (path, size, mtime_ns, sha256) VALUES (?, ?, ?, ?)",
+                                           (path, key[2], key[1], sha256))
+                except sqlite3.Error as e:
+                    print(f"ImageWithMetadata: Model hash database write failed: {e}")
+            return sha256
+        finally:
+            with self.lock:
+                self.pending.pop(key, None)
+
+
+model_hashes = ModelHashService()
+
+
+def short_model_hash(sha256):
+    """A1111 "Model hash" (AutoV2): first 10 hex digits of the file's sha256"""
+    return sha256[:10]
+
+
+CHECKPOINT_EXTENSIONS = ('.safetensors', '.ckpt', '.pt')
+BASE_MODELS = ["sd15", "sd2", "sdxl", "sd3", "flux", "unknown"]
+# Headers larger than this are not safetensors checkpoints we can classify
+SAFETENSORS_MAX_HEADER = 64 * 1024 * 1024
+# modelspec.architecture prefixes written by trainers/mergers
+MODELSPEC_ARCHITECTURES = (
+    ("stable-diffusion-xl", "sdxl"),
+    ("stable-diffusion-v1", "sd15"),
+    ("stable-diffusion-v2", "sd2"),
+    ("stable-diffusion-3", "sd3"),
+    ("flux", "flux"),
+)
+SAFETENSORS_PRECISIONS = {"F32": "fp32", "F16": "fp16", "BF16": "bf16", "F8_E4M3": "fp8", "F8_E5M2": "fp8"}
+
+
+def read_safetensors_header(path):
+    """JSON header of a .safetensors file (8-byte little-endian length + JSON), no tensor data is read"""
+    with open(path, 'rb') as f:
+        length_bytes = f.read(8)
+        if len(length_bytes) != 8:
+            return None
+        length = struct.unpack('<Q', length_bytes)[0]
+        if length > SAFETENSORS_MAX_HEADER:
+            return None
+        return json.loads(f.read(length))
+
+
+def classify_safetensors_header(header):
+    """(architecture, precision) of a checkpoint from its tensor names, shapes, dtypes and __metadata__"""
+    metadata = header.get("__metadata__") or {}
+    architecture = "unknown"
+    
+    spec = str(metadata.get("modelspec.architecture", "")).lower()
+    for prefix, name in MODELSPEC_ARCHITECTURES:
+        if spec.startswith(prefix):
+            architecture = name
+            break
+    
+    if architecture == "unknown":
+        keys = header.keys()
+        cross_attn = header.get("model.diffusion_model.input_blocks.1.1.transformer_blocks.0.attn2.to_k.weight")
+        if any(k.startswith(("model.diffusion_model.double_blocks.", "double_blocks.")) for k in keys):
+            architecture = "flux"
+        elif any(k.startswith(("model.diffusion_model.joint_blocks.", "joint_blocks.")) for k in keys):
+            architecture = "sd3"
+        elif any(k.startswith("conditioner.embedders.1.") for k in keys) or "model.diffusion_model.label_emb.0.0.weight" in header:
+            architecture = "sdxl"
+        elif cross_attn is not None:
+            # Text encoder width: 768 (CLIP ViT-L) for SD1.x, 1024 (OpenCLIP ViT-H) for SD2.x
+            context_dim = (cross_attn.get("shape") or [0, 0])[-1]
+            architecture = {768: "sd15", 1024: "sd2"}.get(context_dim, "unknown")
+    
+    # Precision of the bulk of the weights
+    sizes = {}
+    for key, tensor in header.items():
+        if key == "__metadata__" or not isinstance(tensor, dict):
+            continue
+        offsets = tensor.get("data_offsets") or [0, 0]
+        dtype = tensor.get("dtype", "")
+        sizes[dtype] = sizes.get(dtype, 0) + offsets[1] - offsets[0]
+    precision = SAFETENSORS_PRECISIONS.get(max(sizes, key=sizes.get), "unknown") if sizes else "unknown"
+    
+    return architecture, precision
+
+
+class ModelHeaderIndex:
+    """
+    Checkpoint architecture/precision from safetensors headers, cached by (path, mtime, size)
+    Only the header is read; .ckpt/.pt (pickle) files are reported as unknown
+    """
+    
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.entries = {}
+    
+    def get(self, path):
+        """{"architecture": ..., "precision": ...}"""
+        key = file_key(path)
+        if key is None:
+            # Vanished or unreadable file: nothing to cache
+            return {"architecture": "unknown", "precision": "unknown"}
+        
+        with self.lock:
+            info = self.entries.get(key)
+        if info is not None:
+            return info
+        
+        info = {"architecture": "unknown", "precision": "unknown"}
+        if path.lower().endswith('.safetensors'):
+            try:
+                header = read_safetensors_header(path)
+                if isinstance(header, dict):
+                    info["architecture"], info["precision"] = classify_safetensors_header(header)
+            except Exception as e:
+                print(f"Warning: Could not read safetensors header of {path}: {e}")
+        
+        with self.lock:
+            self.entries[key] = info
+        return info
+
+
+model_headers = ModelHeaderIndex()
+
+
+class CheckpointIndex:
+    """
+    Cached checkpoint name lists keyed by (path, sub_folders, pattern, base_model)
+    Folder listings come from a DirectoryIndex (invalidated by directory mtimes), checkpoint roots are scanned in parallel
+    base_model filtering reads only safetensors headers (ModelHeaderIndex)
+    """
+    
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.directories = DirectoryIndex()
+        self.lists = {}
+    
+    def get(self, base_paths, sub_folders, pattern, base_model="any"):
+        """Sorted checkpoint names (relative to their checkpoints root) found under base_paths"""
+        search_pattern = "**/" + pattern if sub_folders == "true" else pattern
+        scan = lambda base_path: self.directories.get(base_path, search_pattern, CHECKPOINT_EXTENSIONS)
+        if len(base_paths) > 1:
+            entries = list(get_executor("thread", LOAD_WORKERS).map(scan, base_paths))
+        else:
+            entries = [scan(base_path) for base_path in base_paths]
+        
+        key = (tuple(base_paths), sub_folders, pattern, base_model)
+        with self.lock:
+            cached = self.lists.get(key)
+        if cached is not None and len(cached[0]) == len(entries) and all(a is b for a, b in zip(cached[0], entries)):
+            return cached[1]
+        
+        roots = {}
+        for root in folder_paths.get_folder_paths("checkpoints"):
+            roots.setdefault(os.path.normcase(os.path.abspath(root)), root)
+        
+        names = {}
+        root_of_dir = {}
+        for entry in entries:
+            for file_path in entry["paths"]:
+                dir_path, basename = os.path.split(file_path)
+                if dir_path not in root_of_dir:
+                    root_of_dir[dir_path] = self.find_root(dir_path, roots)
+                root = root_of_dir[dir_path]
+                if root is None:
+                    # Not under any checkpoint root: just use basename
+                    name = basename
+                else:
+                    # Relative path with forward slashes for CheckpointLoaderSimple
+                    name = os.path.relpath(file_path, root).replace('\\', '/')
+                names.setdefault(name, file_path)
+        
+        if base_model != "any":
+            # Header reads are small random I/O, run them in parallel
+            matches = get_executor("thread", LOAD_WORKERS).map(
+                lambda file_path: model_headers.get(file_path)["architecture"] == base_model, names.values())
+            names = {name: file_path for (name, file_path), match in zip(names.items(), matches) if match}
+        
+        checkpoint_list = sorted(names)
+        with self.lock:
+            self.lists[key] = (entries, checkpoint_list)
+        return checkpoint_list
+    
+    def find_root(self, dir_path, roots):
+        """Checkpoint root containing dir_path (normalized prefix lookup over its parents)"""
+        current = os.path.normcase(dir_path)
+        while True:
+            root = roots.get(current)
+            if root is not None:
+                return root
+            parent = os.path.dirname(current)
+            if parent == current:
+                return None
+            current = parent
+
+
+checkpoint_index = CheckpointIndex()
+
+
+class CheckpointPreloader:
+    """
+    Reads the next checkpoint file on a background thread so its load hits the OS page cache
+    Reads at most cap_bytes per file in chunks; scheduling another file stops the current read
+    """
+    
+    CHUNK_SIZE = 16 * 1024 * 1024
+    
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.target = None
+        self.stop = None
+    
+    def schedule(self, path, cap_bytes):
+        key = file_key(path)
+        if key is None:
+            return
+        
+        with self.lock:
+            if key == self.target:
+                return
+            if self.stop is not None:
+                self.stop.set()
+            self.target = key
+            self.stop = threading.Event()
+            threading.Thread(target=self.run, args=(path, cap_bytes, self.stop),
+                             name="ImageWithMetadataPreload", daemon=True).start()
+    
+    def run(self, path, cap_bytes, stop):
+        buffer = bytearray(self.CHUNK_SIZE)
+        remaining = cap_bytes
+        try:
+            with open(path, 'rb', buffering=0) as f:
+                while remaining > 0 and not stop.is_set():
+                    read = f.readinto(memoryview(buffer)[:min(self.CHUNK_SIZE, remaining)])
+                    if not read:
+                        break
+                    remaining -= read
+        except OSError as e:
+            print(f"Warning: Could not preload {path}: {e}")
+
+
+checkpoint_preloader = CheckpointPreloader()
+
+
 class CheckpointLoaderWithNames:
     """
     Checkpoint loader that returns model and VAE names as strings
@@ -598,19 +2550,25 @@ class CheckpointLoaderWithNames:
             },
             "optional": {
                 "vae_name": (["Baked VAE"] + folder_paths.get_filename_list("vae"),),
+                "model_cache_mb": ("INT", {"default": 0, "min": 0, "max": 1048576, "step": 1024}),
+                "compute_hash": ("BOOLEAN", {"default": False}),
             }
         }
     
-    RETURN_TYPES = ("MODEL", "CLIP", "VAE", "STRING", "STRING")
-    RETURN_NAMES = ("model", "clip", "vae", "checkpoint_name", "vae_name")
+    RETURN_TYPES = ("MODEL", "CLIP", "VAE", "STRING", "STRING", "STRING")
+    RETURN_NAMES = ("model", "clip", "vae", "checkpoint_name", "vae_name", "checkpoint_hash")
     FUNCTION = "load_checkpoint"
     CATEGORY = "loaders"
 
-    def load_checkpoint(self, ckpt_name, vae_name="Baked VAE"):
+    def load_checkpoint(self, ckpt_name, vae_name="Baked VAE", model_cache_mb=0, compute_hash=False):
+        # Hash in the background while the checkpoint loads (free once stored)
+        ckpt_path = folder_paths.get_full_path("checkpoints", ckpt_name) if compute_hash else None
+        if ckpt_path:
+            model_hashes.request(ckpt_path)
+        
         # Load checkpoint
-        from nodes import CheckpointLoaderSimple, VAELoader
-        loader = CheckpointLoaderSimple()
-        model, clip, vae = loader.load_checkpoint(ckpt_name)
+        model, clip, vae = load_checkpoint_cached(ckpt_name, model_cache_mb)
+        checkpoint_hash = short_model_hash(model_hashes.get(ckpt_path)) if ckpt_path else ""
         
         actual_vae_name = ""
         
@@ -620,27 +2578,28 @@ class CheckpointLoaderWithNames:
             actual_vae_name = f"{ckpt_name} (Baked VAE)"
         else:
             # Load external VAE
-            vae_loader = VAELoader()
-            vae = vae_loader.load_vae(vae_name)[0]
+            vae = load_vae_cached(vae_name, model_cache_mb)
             actual_vae_name = vae_name
         
-        return (model, clip, vae, ckpt_name, actual_vae_name)
+        return (model, clip, vae, ckpt_name, actual_vae_name, checkpoint_hash)
 
 
 class RandomCheckpointLoaderWithNames:
     """
     Random/Sequential checkpoint loader with metadata output
     Load checkpoints randomly or sequentially from folder with filtering options
+    scheduled mode runs jobs_per_checkpoint jobs per checkpoint before switching (one model load per checkpoint)
     """
     
     def __init__(self):
         self.HDB = counter_db
+        self.loaded = None  # (file key, (model, clip, vae)) kept between scheduled runs
     
     @classmethod
     def INPUT_TYPES(s):
         return {
             "required": {
-                "mode": (["single", "random"],),
+                "mode": (["single", "random", "scheduled"],),
                 "seed": ("INT", {"default": 0, "min": 0, "max": 0xffffffffffffffff, "step": 1}),
                 "path": ("STRING", {"default": "", "multiline": False}),
                 "sub_folders": (["false", "true"],),
@@ -650,48 +2609,85 @@ class RandomCheckpointLoaderWithNames:
             },
             "optional": {
                 "vae_name": (["Baked VAE"] + folder_paths.get_filename_list("vae"),),
+                "model_cache_mb": ("INT", {"default": 0, "min": 0, "max": 1048576, "step": 1024}),
+                "jobs_per_checkpoint": ("INT", {"default": 1, "min": 1, "max": 10000, "step": 1}),
+                "base_model": (["any"] + BASE_MODELS,),
+                "preload_next": ("BOOLEAN", {"default": False}),
+                "preload_mb": ("INT", {"default": 8192, "min": 0, "max": 1048576, "step": 1024}),
+                "compute_hash": ("BOOLEAN", {"default": False}),
             }
         }
     
-    RETURN_TYPES = ("MODEL", "CLIP", "VAE", "STRING", "STRING")
-    RETURN_NAMES = ("model", "clip", "vae", "checkpoint_name", "vae_name")
+    RETURN_TYPES = ("MODEL", "CLIP", "VAE", "STRING", "STRING", "INT", "STRING")
+    RETURN_NAMES = ("model", "clip", "vae", "checkpoint_name", "vae_name", "job_index", "checkpoint_hash")
     FUNCTION = "load_checkpoint"
     CATEGORY = "loaders"
     
-    def load_checkpoint(self, mode, seed, path, sub_folders, pattern, label, index, vae_name="Baked VAE"):
+    def load_checkpoint(self, mode, seed, path, sub_folders, pattern, label, index, vae_name="Baked VAE",
+                        model_cache_mb=0, jobs_per_checkpoint=1, base_model="any",
+                        preload_next=False, preload_mb=8192, compute_hash=False):
         # Get checkpoint list
-        checkpoint_list = self.get_checkpoint_list(path, sub_folders, pattern)
+        checkpoint_list = self.get_checkpoint_list(path, sub_folders, pattern, base_model)
         
         if not checkpoint_list:
-            raise ValueError(f"No checkpoints found with path='{path}', pattern='{pattern}'")
+            raise ValueError(f"No checkpoints found with path='{path}', pattern='{pattern}', base_model='{base_model}'")
         
         # Check if settings changed (for counter reset)
-        counter_key = f"{path}_{sub_folders}_{pattern}"
+        counter_key = f"{path}_{sub_folders}_{pattern}" + (f"_{base_model}" if base_model != "any" else "")
         stored_key = self.HDB.get_pattern(label)  # Reusing pattern storage for counter_key
         
         if stored_key != counter_key:
-            self.HDB.set_counter(label, 0)
-            self.HDB.set_pattern(label, counter_key)
+            self.HDB.update(label, counter=0, pattern=counter_key)
         
         # Select checkpoint based on mode
+        job_index = index
+        next_name = None
         if mode == "single":
             # Single mode: use index with loop
             selected_index = index % len(checkpoint_list)
             ckpt_name = checkpoint_list[selected_index]
+            next_name = checkpoint_list[(selected_index + 1) % len(checkpoint_list)]
+        elif mode == "scheduled":
+            # Scheduled mode: index walks checkpoint groups, each checkpoint runs all its jobs in a row
+            order = self.get_schedule(label, checkpoint_list, seed, counter_key, jobs_per_checkpoint)
+            position = index % (len(order) * jobs_per_checkpoint)
+            group = position // jobs_per_checkpoint
+            ckpt_name = order[group]
+            next_name = order[(group + 1) % len(order)]
+            job_index = position % jobs_per_checkpoint
         else:  # random
             # Random mode: use seed
             import random
             random.seed(seed)
             ckpt_name = random.choice(checkpoint_list)
         
-        # Load checkpoint
-        from nodes import CheckpointLoaderSimple, VAELoader
-        loader = CheckpointLoaderSimple()
+        # Hash in the background while the checkpoint loads (free once stored)
+        ckpt_path = folder_paths.get_full_path("checkpoints", ckpt_name) if compute_hash else None
+        if ckpt_path:
+            model_hashes.request(ckpt_path)
         
-        try:
-            model, clip, vae_loaded = loader.load_checkpoint(ckpt_name)
-        except Exception as e:
-            raise ValueError(f"Failed to load checkpoint '{ckpt_name}': {str(e)}")
+        # Load checkpoint (scheduled mode reuses the checkpoint of the previous job)
+        key = model_file_key("checkpoints", ckpt_name) if mode == "scheduled" else None
+        if key is not None and self.loaded is not None and self.loaded[0] == key:
+            model, clip, vae_loaded = self.loaded[1]
+        else:
+            self.loaded = None
+            try:
+                model, clip, vae_loaded = load_checkpoint_cached(ckpt_name, model_cache_mb)
+            except Exception as e:
+                raise ValueError(f"Failed to load checkpoint '{ckpt_name}': {str(e)}")
+            if key is not None:
+                self.loaded = (key, (model, clip, vae_loaded))
+        
+        # Read the next checkpoint into the page cache while this prompt runs
+        if preload_next and preload_mb > 0 and next_name is not None and next_name != ckpt_name:
+            next_path = folder_paths.get_full_path("checkpoints", next_name)
+            if next_path:
+                checkpoint_preloader.schedule(next_path, preload_mb * 1024 * 1024)
+                if compute_hash:
+                    model_hashes.request(next_path)
+        
+        checkpoint_hash = short_model_hash(model_hashes.get(ckpt_path)) if ckpt_path else ""
         
         actual_vae_name = ""
         
@@ -702,87 +2698,58 @@ class RandomCheckpointLoaderWithNames:
             actual_vae_name = f"{ckpt_name} (Baked VAE)"
         else:
             # Load external VAE
-            vae_loader = VAELoader()
-            vae = vae_loader.load_vae(vae_name)[0]
+            vae = load_vae_cached(vae_name, model_cache_mb)
             actual_vae_name = vae_name
         
-        return (model, clip, vae, ckpt_name, actual_vae_name)
+        return (model, clip, vae, ckpt_name, actual_vae_name, job_index, checkpoint_hash)
+    
+    def get_schedule(self, label, checkpoint_list, seed, counter_key, jobs_per_checkpoint):
+        """Checkpoint order of a scheduled sweep, shuffled by seed and stored per label"""
+        import random
+        schedule_key = f"{label}_schedule"
+        settings = [counter_key, seed, jobs_per_checkpoint]
+        
+        stored = self.HDB.get(schedule_key)
+        if (isinstance(stored, dict) and stored.get("settings") == settings
+                and sorted(stored.get("order", [])) == checkpoint_list):
+            return stored["order"]
+        
+        # New sweep (settings or checkpoint set changed)
+        order = list(checkpoint_list)
+        random.Random(seed).shuffle(order)
+        self.HDB.update(label, schedule={"settings": settings, "order": order})
+        return order
     
-    def get_checkpoint_list(self, path, sub_folders, pattern):
+    def get_checkpoint_list(self, path, sub_folders, pattern, base_model="any"):
         """Get list of checkpoint files based on path, sub_folders, and pattern"""
-        checkpoint_list = []
-        
-        # Determine base path
+        # Determine base paths
         if not path or path.strip() == "":
-            # Empty path: use default checkpoints folder
+            # Empty path: all checkpoints folders
             base_paths = folder_paths.get_folder_paths("checkpoints")
-            if not base_paths:
-                return []
-            base_path = base_paths[0]
         elif not os.path.exists(path):
-            # Path doesn't exist: fallback to checkpoints folder
+            # Path doesn't exist: fallback to checkpoints folders
             print(f"Warning: Path '{path}' not found, using default checkpoints folder")
             base_paths = folder_paths.get_folder_paths("checkpoints")
-            if not base_paths:
-                return []
-            base_path = base_paths[0]
         else:
             # Valid path
-            base_path = os.path.abspath(path)
+            base_paths = [path]
         
-        # Get files based on sub_folders setting
-        allowed_extensions = ('.safetensors', '.ckpt', '.pt')
+        base_paths = [os.path.abspath(p) for p in base_paths if os.path.isdir(p)]
+        if not base_paths:
+            return []
         
-        if sub_folders == "true":
-            # Include subfolders (recursive)
-            search_pattern = os.path.join(glob.escape(base_path), "**", pattern)
-            files = glob.glob(search_pattern, recursive=True)
-        else:
-            # Only specified folder (non-recursive)
-            search_pattern = os.path.join(glob.escape(base_path), pattern)
-            files = glob.glob(search_pattern, recursive=False)
-        
-        # Get checkpoint base path for relative path calculation
-        checkpoint_base_paths = folder_paths.get_folder_paths("checkpoints")
-        
-        # Filter checkpoint files and convert to relative paths
-        for file_path in files:
-            if os.path.isfile(file_path) and file_path.lower().endswith(allowed_extensions):
-                # Convert to relative path from checkpoints folder
-                # This is needed for CheckpointLoaderSimple to find the file
-                file_added = False
-                
-                # Try to find which checkpoint base path this file belongs to
-                for ckpt_base in checkpoint_base_paths:
-                    try:
-                        # Get relative path from this checkpoint base
-                        rel_path = os.path.relpath(file_path, ckpt_base)
-                        # If the relative path doesn't go up (..), it's under this base
-                        if not rel_path.startswith('..'):
-                            # Use forward slashes for ComfyUI compatibility
-                            rel_path = rel_path.replace('\\', '/')
-                            checkpoint_list.append(rel_path)
-                            file_added = True
-                            break
-                    except ValueError:
-                        # Different drives on Windows
-                        continue
-                
-                # If file wasn't under any checkpoint base, just use basename
-                if not file_added:
-                    checkpoint_list.append(os.path.basename(file_path))
-        
-        # Remove duplicates and sort
-        checkpoint_list = list(set(checkpoint_list))
-        checkpoint_list.sort()
-        
-        return checkpoint_list
+        return checkpoint_index.get(base_paths, sub_folders, pattern, base_model)
+
+
+# Warm the directory index in the background at server start
+threading.Thread(target=prewarm_image_indexes, name="ImageWithMetadataIndex", daemon=True).start()
 
 
 # Node mappings
 NODE_CLASS_MAPPINGS = {
     "SaveImageWithMetadata": SaveImageWithMetadata,
     "LoadImageWithMetadata": LoadImageWithMetadata,
+    "SearchImagesWithMetadata": SearchImagesWithMetadata,
     "CheckpointLoaderWithNames": CheckpointLoaderWithNames,
     "RandomCheckpointLoaderWithNames": RandomCheckpointLoaderWithNames,
 }
@@ -790,6 +2757,7 @@ NODE_CLASS_MAPPINGS = {
 NODE_DISPLAY_NAME_MAPPINGS = {
     "SaveImageWithMetadata": "Save Image with Metadata",
     "LoadImageWithMetadata": "Load Image with Metadata",
+    "SearchImagesWithMetadata": "Search Images with Metadata",
     "CheckpointLoaderWithNames": "Checkpoint Loader with Names",
     "RandomCheckpointLoaderWithNames": "Random Checkpoint Loader with Names",
 }